@@ -17,14 +17,6 @@ class MainGroupMessage(Message):
     types = ['i','i']
     packet_type = 101
 
-class ThreeSecGroupMessage(Message):
-    properties = []
-    packet_type = 102
-
-class TenSecGroupMessage(Message):
-    properties = []
-    packet_type = 103
-
 class MainAction(Actor):
     subscriptions = ['MainGroupMessage']
     def __init__(self):
@@ -39,32 +31,23 @@ class MainAction(Actor):
         print 'Ten Second Count %s -- Three Second Count %s' % (self.TenSecCount,self.ThreeSecCount)
 
 class ThreeSecAction(Actor):
-    subscriptions = ['ThreeSecGroupMessage']
     def __init__(self):
         Actor.__init__(self)
         self.Count=0
-        self.startTime = time.time()
-    def handle_ThreeSecGroupMessage(self, msg):
+        # a timer replaces polling time.time() in update
+        self.schedule_every(3.0, self.report)
+    def report(self):
         self.Count=self.Count+1
         ActorManager.get_singleton().queue_message_to_group(ActorManager.get_singleton().PYSAGE_MAIN_GROUP,MainGroupMessage(ThreeSecCount=self.Count, TenSecCount=0))
-    def update(self):
-        if time.time() - self.startTime >= 3.0:
-            ActorManager.get_singleton().queue_message(ThreeSecGroupMessage())
-            self.startTime=time.time()
 
 class TenSecAction(Actor):
-    subscriptions = ['TenSecGroupMessage']
     def __init__(self):
         Actor.__init__(self)
         self.Count=0
-        self.startTime = time.time()
-    def handle_TenSecGroupMessage(self, msg):
+        self.schedule_every(10.0, self.report)
+    def report(self):
         self.Count=self.Count+1
         ActorManager.get_singleton().queue_message_to_group(ActorManager.get_singleton().PYSAGE_MAIN_GROUP,MainGroupMessage(TenSecCount=self.Count, ThreeSecCount=0))
-    def update(self):
-        if time.time() - self.startTime >= 10.0:
-            ActorManager.get_singleton().queue_message(TenSecGroupMessage())
-            self.startTime=time.time()
 
 if __name__ == '__main__':
     # note VERY IMPORT TO HAVE THE FOLLOWING THREE LINES UNDER __NAME__ == __MAIN__, ADD TO DOCUMENTATION
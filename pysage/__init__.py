@@ -1,5 +1,6 @@
-from messaging import WildCardMessageType
+from messaging import WildCardMessageType, Sleep, WaitForMessage, WaitForReply, offload, OFFLOAD_THREAD, OFFLOAD_PROCESS
 from system import *
+from arrays import ActorArray, ArrayEntry
 
-__VERSION__ = '1.6.0'
+__VERSION__ = '1.7.0'
 
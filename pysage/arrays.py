@@ -0,0 +1,102 @@
+# arrays.py
+# actor arrays: populations of similar actors updated with a single call
+import array
+from system import Actor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+NUMPY_AVAILABLE = numpy is not None
+
+class ArrayEntry(Actor):
+    '''
+    one member of an ActorArray.  it is a regular actor with a gid that messages can be designated to,
+    its numeric state lives in the columns of the array: ``entry['x']``, ``entry['x'] = 1.0``
+    '''
+    def __init__(self, array, index):
+        Actor.__init__(self)
+        self.array = array
+        self.index = index
+    def __getitem__(self, name):
+        return self.array._columns[name][self.index]
+    def __setitem__(self, name, value):
+        self.array._columns[name][self.index] = value
+
+class ActorArray(Actor):
+    '''
+    population of similar actors whose state is stored column wise, in numpy arrays if available or in array.array
+
+    the manager calls ``update_batch`` once per tick for the whole population instead of calling ``update``
+    on each member.  members are ``entry_class`` instances, they subscribe and handle messages like other actors.
+    '''
+    # column names, or (name, array typecode) pairs, "d" by default
+    columns = []
+    entry_class = ArrayEntry
+    def __init__(self, capacity=64):
+        Actor.__init__(self)
+        self.size = 0
+        self.entries = []
+        # the manager members are registered with, set by ActorManager.register_actor_array
+        self.manager = None
+        self._typecodes = dict(isinstance(c, tuple) and c or (c, 'd') for c in self.columns)
+        if NUMPY_AVAILABLE:
+            self._columns = dict((name, numpy.zeros(capacity, typecode)) for name, typecode in self._typecodes.items())
+        else:
+            self._columns = dict((name, array.array(typecode)) for name, typecode in self._typecodes.items())
+    def __len__(self):
+        return self.size
+    def column(self, name):
+        '''
+        returns the state of every member for the column, in member order.
+        with numpy it is a view to update in place, fetch it again after spawning
+        '''
+        if NUMPY_AVAILABLE:
+            return self._columns[name][:self.size]
+        return self._columns[name]
+    def spawn(self, count=1, **values):
+        '''
+        adds ``count`` members, with their columns set to ``values`` (0 otherwise)
+
+        :Return: the new entries, registered with the manager if the array is
+        '''
+        start = self.size
+        self.size += count
+        for name, typecode in self._typecodes.items():
+            value = values.get(name, 0)
+            column = self._columns[name]
+            if NUMPY_AVAILABLE:
+                if self.size > len(column):
+                    grown = numpy.zeros(max(self.size, 2 * len(column)), typecode)
+                    grown[:start] = column[:start]
+                    column = self._columns[name] = grown
+                column[start:self.size] = value
+            else:
+                column.extend([value] * count)
+        entries = [self.entry_class(self, i) for i in xrange(start, self.size)]
+        self.entries.extend(entries)
+        if self.manager is not None:
+            self.manager.register_actors(entries)
+        return entries
+    def despawn(self, entries):
+        '''removes members, the last members are moved into the freed rows'''
+        entries = list(entries)
+        if self.manager is not None:
+            self.manager.unregister_actors(entries)
+        for entry in entries:
+            last = self.entries.pop()
+            if last is not entry:
+                for column in self._columns.itervalues():
+                    column[entry.index] = column[last.index]
+                last.index = entry.index
+                self.entries[entry.index] = last
+            if not NUMPY_AVAILABLE:
+                for column in self._columns.itervalues():
+                    column.pop()
+            self.size -= 1
+            entry.array = None
+    def update(self, *args, **kws):
+        self.update_batch(*args, **kws)
+    def update_batch(self, *args, **kws):
+        '''updates the whole population, override it to work on ``column``'''
+        pass
@@ -8,22 +8,402 @@ import time
 import util
 import process as processing
 import inspect
+import itertools
+import heapq
+import sys
+import threading
+import traceback
+import array
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import concurrent.futures as futures
+except ImportError:
+    FUTURES_AVAILABLE = False
+else:
+    FUTURES_AVAILABLE = True
 
 logger = processing.get_logger()
 
 WildCardMessageType = '*'
 
+# what queue_message does with a message that does not fit, see MessageManager.set_queue_capacity
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_SIGNAL = 'signal'
+
 def MessageID():
     '''generates unique message IDs per runtime'''
-    i = 0
-    while True:
-        yield i
-        i += 1
+    # itertools.count is implemented in C, it is cheaper than a generator and safe to share between threads
+    return itertools.count()
 messageID = MessageID()
+next_message_id = messageID.next
 
 class InvalidMessageProperty(Exception):
     pass
 
+class Sleep(object):
+    '''coroutine directive: yield it from a handler coroutine to resume after ``seconds`` have passed'''
+    __slots__ = ('seconds',)
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+class WaitForMessage(object):
+    '''coroutine directive: resume with the next dispatched message of ``message_type``
+    
+       if ``timeout`` seconds pass first, the coroutine is resumed with None
+    '''
+    __slots__ = ('message_type', 'timeout')
+    def __init__(self, message_type, timeout=None):
+        self.message_type = message_type
+        self.timeout = timeout
+
+class WaitForReply(object):
+    '''coroutine directive: resume with the next dispatched message whose ``reply_to`` is ``gid``
+    
+       if ``timeout`` seconds pass first, the coroutine is resumed with None
+    '''
+    __slots__ = ('gid', 'timeout')
+    def __init__(self, gid, timeout=None):
+        self.gid = gid
+        self.timeout = timeout
+
+class _QueueLimit(object):
+    __slots__ = ('capacity', 'policy', 'callback')
+    def __init__(self, capacity, policy, callback):
+        self.capacity = capacity
+        self.policy = policy
+        self.callback = callback
+
+class Metrics(object):
+    '''dispatch statistics collected by a message manager, see MessageManager.enable_metrics'''
+    def __init__(self, sample_size=1024):
+        self.sample_size = sample_size
+        self.reset()
+    def reset(self):
+        # message type -> [count, total dispatch time, recent queue latencies]
+        self.message_types = {}
+        # phase name -> total time spent in it
+        self.phases = {}
+        self.ticks = 0
+        self.queue_high_water_mark = 0
+    def add_message(self, message_type, latency, duration):
+        stats = self.message_types.get(message_type)
+        if stats is None:
+            stats = self.message_types[message_type] = [0, 0.0, collections.deque(maxlen=self.sample_size)]
+        stats[0] += 1
+        stats[1] += duration
+        if latency is not None:
+            stats[2].append(latency)
+    def add_handler_time(self, message_type, duration):
+        '''adds handler time spent outside the dispatch of a single message, such as a batch handler'''
+        stats = self.message_types.get(message_type)
+        if stats is None:
+            stats = self.message_types[message_type] = [0, 0.0, collections.deque(maxlen=self.sample_size)]
+        stats[1] += duration
+    def add_phase(self, phase, start):
+        '''adds the time since "start" to the phase, returns the current time'''
+        now = util.get_time()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - start
+        return now
+    def add_queue_depth(self, depth):
+        if depth > self.queue_high_water_mark:
+            self.queue_high_water_mark = depth
+    def snapshot(self):
+        '''returns the collected statistics as plain dictionaries'''
+        message_types = {}
+        for message_type, (count, duration, latencies) in self.message_types.iteritems():
+            latencies = sorted(latencies)
+            message_types[message_type] = {'count': count,
+                                           'handler_time': duration,
+                                           'latency_p50': _percentile(latencies, .5),
+                                           'latency_p99': _percentile(latencies, .99)}
+        return {'message_types': message_types,
+                'phases': dict(self.phases),
+                'ticks': self.ticks,
+                'queue_high_water_mark': self.queue_high_water_mark}
+
+class Profiler(object):
+    '''
+    times handlers and actor updates, keeping the ones slower than ``threshold`` seconds in a ring buffer
+    
+    with ``sample_stacks`` a watchdog thread records the stack of a call once it runs past the threshold
+    '''
+    def __init__(self, threshold, ring_size=1000, sample_stacks=False):
+        self.threshold = threshold
+        # (receiver class name, message type or "update", duration, sampled stack or None)
+        self.slow_calls = collections.deque(maxlen=ring_size)
+        # [start, sampled stack, thread ident] of the calls in progress, innermost last
+        self._running = []
+        self._stop = None
+        if sample_stacks:
+            self._stop = threading.Event()
+            watchdog = threading.Thread(target=self._watch, name='pysage profiler watchdog')
+            watchdog.daemon = True
+            watchdog.start()
+    def stop(self):
+        if self._stop:
+            self._stop.set()
+    def _watch(self):
+        while not self._stop.is_set():
+            self._stop.wait(self.threshold / 2.0)
+            now = util.get_time()
+            stack = None
+            for running in list(self._running):
+                if running[1] is None and now - running[0] >= self.threshold:
+                    if stack is None:
+                        frame = sys._current_frames().get(running[2])
+                        if frame is None:
+                            break
+                        stack = ''.join(traceback.format_stack(frame))
+                    running[1] = stack
+    def call(self, receiver, label, func, *args, **kws):
+        '''calls ``func`` and records it if it took longer than the threshold'''
+        running = [util.get_time(), None, threading.current_thread().ident]
+        self._running.append(running)
+        try:
+            return func(*args, **kws)
+        finally:
+            self._running.pop()
+            duration = util.get_time() - running[0]
+            if duration >= self.threshold:
+                self.slow_calls.append((type(receiver).__name__, label, duration, running[1]))
+    def wrap(self, receiver, message_type, handler):
+        '''returns a handler that is timed through ``call``'''
+        return _ProfiledHandler(self, receiver, message_type, handler)
+    def report(self, n=10):
+        '''aggregates the recorded slow calls by receiver class and message type, slowest total first'''
+        offenders = {}
+        for class_name, label, duration, stack in self.slow_calls:
+            entry = offenders.get((class_name, label))
+            if entry is None:
+                entry = offenders[(class_name, label)] = {'class': class_name, 'message_type': label, 'count': 0,
+                                                          'total': 0.0, 'max': 0.0, 'stack': None}
+            entry['count'] += 1
+            entry['total'] += duration
+            entry['max'] = max(entry['max'], duration)
+            entry['stack'] = stack or entry['stack']
+        return sorted(offenders.values(), key=lambda x: x['total'], reverse=True)[:n]
+
+class _ProfiledHandler(object):
+    '''dispatch table entry of a handler timed by a profiler, see Profiler.wrap'''
+    __slots__ = ('profiler', 'receiver', 'message_type', 'handler')
+    def __init__(self, profiler, receiver, message_type, handler):
+        self.profiler = profiler
+        self.receiver = receiver
+        self.message_type = message_type
+        self.handler = handler
+    def __call__(self, msg):
+        return self.profiler.call(self.receiver, self.message_type, self.handler, msg)
+    @property
+    def offload(self):
+        return getattr(self.handler, 'offload', None)
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+# pools an offloaded handler can run in, see offload
+OFFLOAD_THREAD = 'thread'
+OFFLOAD_PROCESS = 'process'
+
+def offload(pool=OFFLOAD_THREAD):
+    '''decorator that marks a message handler to run in the manager's thread or process pool
+    
+       the handler does not block the tick, the messages it returns (a message or a list of messages) are 
+       queued when it completes.  handlers of the same receiver complete in the order they were dispatched.  
+       handlers run in the process pool have no receiver to work on, they must be staticmethods.  
+       without ``concurrent.futures`` the handlers run inline.  see MessageManager.set_offload_pools
+    
+       usage: ``@offload``, or ``@offload(OFFLOAD_PROCESS)`` above ``@staticmethod``.  batch handlers can not be
+       offloaded
+    '''
+    if callable(pool):
+        pool.offload = OFFLOAD_THREAD
+        return pool
+    if pool not in (OFFLOAD_THREAD, OFFLOAD_PROCESS):
+        raise ValueError('Unknown offload pool %r, use OFFLOAD_THREAD or OFFLOAD_PROCESS' % (pool,))
+    def mark(func):
+        if pool == OFFLOAD_PROCESS:
+            if not isinstance(func, staticmethod):
+                raise TypeError('Handler %s offloaded to the process pool must be a staticmethod, put @offload(OFFLOAD_PROCESS) above @staticmethod' % getattr(func, '__name__', func))
+            func.__func__.offload = pool
+            return func
+        func.offload = pool
+        return func
+    return mark
+
+def _run_in_process(cls, name, msg):
+    '''runs an offloaded staticmethod handler in a pool process, where the receiver is not available'''
+    return getattr(cls, name)(msg)
+
+class _OffloadState(object):
+    '''per receiver bookkeeping of offloaded handler calls, only touched by the thread that ticks'''
+    __slots__ = ('running', 'backlog', 'next_sequence', 'next_release', 'done')
+    def __init__(self):
+        self.running = 0
+        # (handler, message, sequence) waiting for the receiver's concurrency limit
+        self.backlog = collections.deque()
+        self.next_sequence = 0
+        self.next_release = 0
+        # sequence -> finished future, held until the earlier calls are done
+        self.done = {}
+
+class _OffloadedHandler(object):
+    '''dispatch table entry that submits the handler to a pool instead of calling it'''
+    __slots__ = ('manager', 'receiver', 'handler')
+    def __init__(self, manager, receiver, handler):
+        self.manager = manager
+        self.receiver = receiver
+        self.handler = handler
+    def __call__(self, msg):
+        self.manager._submit_offloaded(self.receiver, self.handler, msg)
+        # the message can not be consumed, the result is not known yet
+        return False
+
+class MessageBatch(list):
+    '''the messages of one type dispatched to a receiver during a tick, in dispatch order'''
+    def __init__(self, message_type):
+        list.__init__(self)
+        self.message_type = message_type
+    def column(self, name, typecode=None):
+        '''
+        returns the property of every message in the batch: a list, 
+        or given an array typecode, a numpy array if numpy is installed and an array.array otherwise
+        '''
+        values = [msg.get_property(name) for msg in self]
+        if typecode is None:
+            return values
+        if numpy is not None:
+            return numpy.array(values, typecode)
+        return array.array(typecode, values)
+
+class _BatchCollector(object):
+    '''dispatch table entry of a batch handler, collects messages until the end of the tick's dispatch'''
+    __slots__ = ('manager', 'receiver', 'handler', 'message_type', 'batch')
+    def __init__(self, manager, receiver, handler, message_type):
+        self.manager = manager
+        self.receiver = receiver
+        self.handler = handler
+        self.message_type = message_type
+        self.batch = None
+    def __call__(self, msg):
+        if self.batch is None:
+            self.batch = MessageBatch(self.message_type)
+            self.manager._pending_batches.append(self)
+        self.batch.append(msg)
+        # batched messages are never consumed
+        return False
+    def flush(self):
+        batch, self.batch = self.batch, None
+        return self.handler(batch)
+
+class _Waiter(object):
+    '''a coroutine parked in one of the message manager's wait indexes'''
+    __slots__ = ('coroutine', 'index', 'key', 'timer')
+    def __init__(self, coroutine, index, key):
+        self.coroutine = coroutine
+        self.index = index
+        self.key = key
+        self.timer = None
+
+# segment wild cards of hierarchical message types such as "market.eq.AAPL"
+TopicSeparator = '.'
+TopicAnySegment = '*'
+TopicAllSegments = '#'
+
+def is_topic_pattern(message_type):
+    '''returns true if the subscription is a segment pattern such as "market.*.AAPL" or "market.#"'''
+    if message_type == WildCardMessageType:
+        return False
+    if TopicAnySegment not in message_type and TopicAllSegments not in message_type:
+        return False
+    segments = message_type.split(TopicSeparator)
+    return TopicAnySegment in segments or TopicAllSegments in segments
+
+def handler_name(message_type):
+    '''returns the name of the receiver method that handles the message type or subscription pattern
+    
+       segments are joined with underscores, "*" becomes "any" and "#" becomes "all":
+       "market.eq.AAPL" -> handle_market_eq_AAPL, "market.#" -> handle_market_all
+    '''
+    if TopicSeparator not in message_type:
+        return 'handle_' + message_type
+    return 'handle_' + '_'.join({TopicAnySegment: 'any', TopicAllSegments: 'all'}.get(s, s) for s in message_type.split(TopicSeparator))
+
+def batch_handler_name(message_type):
+    '''returns the name of the receiver method that handles all messages of the type dispatched in a tick at once'''
+    return 'handle_batch_' + handler_name(message_type)[len('handle_'):]
+
+class _TopicNode(object):
+    __slots__ = ('children', 'subscribers')
+    def __init__(self):
+        self.children = {}
+        # (receiver, pattern) pairs whose pattern ends at this node
+        self.subscribers = set()
+
+class TopicTrie(object):
+    '''segment trie of subscription patterns
+    
+       "*" matches exactly one segment, "#" matches zero or more trailing segments.  
+       a match only walks the segments of the message type, whatever the number of patterns.
+    '''
+    def __init__(self):
+        self.root = _TopicNode()
+        self.size = 0
+    def __len__(self):
+        return self.size
+    def add(self, pattern, receiver):
+        segments = pattern.split(TopicSeparator)
+        if TopicAllSegments in segments[:-1]:
+            raise ValueError('"%s" may only be the last segment of pattern "%s"' % (TopicAllSegments, pattern))
+        node = self.root
+        for s in segments:
+            node = node.children.setdefault(s, _TopicNode())
+        if (receiver, pattern) not in node.subscribers:
+            node.subscribers.add((receiver, pattern))
+            self.size += 1
+    def remove(self, pattern, receiver):
+        path = [self.root]
+        segments = pattern.split(TopicSeparator)
+        for s in segments:
+            node = path[-1].children.get(s)
+            if node is None:
+                return False
+            path.append(node)
+        if (receiver, pattern) not in path[-1].subscribers:
+            return False
+        path[-1].subscribers.remove((receiver, pattern))
+        self.size -= 1
+        # prune the branch of nodes left empty
+        for depth in range(len(segments), 0, -1):
+            if path[depth].subscribers or path[depth].children:
+                break
+            del path[depth - 1].children[segments[depth - 1]]
+        return True
+    def match(self, message_type):
+        '''returns the (receiver, pattern) pairs whose patterns match the message type'''
+        matched = set()
+        self._match(self.root, message_type.split(TopicSeparator), 0, matched)
+        return matched
+    def _match(self, node, segments, i, matched):
+        rest = node.children.get(TopicAllSegments)
+        if rest is not None:
+            matched.update(rest.subscribers)
+        if i == len(segments):
+            matched.update(node.subscribers)
+            return
+        child = node.children.get(segments[i])
+        if child is not None:
+            self._match(child, segments, i + 1, matched)
+        child = node.children.get(TopicAnySegment)
+        if child is not None:
+            self._match(child, segments, i + 1, matched)
+
 class MessageReceiver(object):
     '''generic message receiver class that game object inherits from'''
     # message types this message receiver will subscribe to
@@ -37,30 +417,60 @@ class MessageReceiver(object):
             returns: True if a message is consumed
         ''' 
         # see if this mssage receiver implements a handler for this msg
-        method = 'handle_' + msg.message_type
+        method = handler_name(msg.message_type)
         if hasattr(self, method):
             return getattr(self, method)(msg)
         else:
             logger.info("Actor %s's '%s' method wasn't found.  Message '%s' skipped" % (self, method, msg))
             return False
+    def get_handler(self, message_type):
+        '''returns the callable that handles messages of the given type
+        
+           the message manager resolves this once per (receiver, type) pair and caches the result.
+           receivers that override ``handle_message`` always have it called directly.
+        '''
+        if type(self).handle_message.__func__ is not MessageReceiver.handle_message.__func__:
+            return self.handle_message
+        return getattr(self, handler_name(message_type), None) or self.handle_message
     def update(self, evt=None):
         pass
     @property
     def gid(self):
         return id(self)
         
-class Message(object):
-    '''generic message class'''
+class MessageBase(object):
+    '''behaviour of all messages, without an instance dictionary so that slotted messages can derive from it'''
+    __slots__ = ()
     properties= []
     _LOG_LEVEL = 0
+    # messages with higher priority are processed first, see MessageManager.queue_message
+    priority = 0
+    # gid of the message this one replies to, resumes coroutines waiting with WaitForReply
+    reply_to = None
+    # "latest value wins" messages list the properties that identify the value here, see get_conflation_key
+    conflation_key = None
+    # when the message was queued, only recorded while metrics are enabled
+    queued_at = None
+    # name of the property holding the (x, y) position the message is about, see ActorManager.set_interest
+    location = None
+    # seconds a message of this class stays worth dispatching after its creation, None for ever
+    ttl = None
+    # time (in ``util.get_time`` seconds) after which the message is dropped instead of dispatched
+    deadline = None
+    _message_type = ''
     def __init__(self, sender=None, receiverID=None, message_type='', **kws):
         self._properties = dict( (x, None) for x in self.properties )
         for name, value in kws.items():
             self.lazy_set_property(name, value)
         self.sender = sender
-        self.gid = messageID.next()
+        self.gid = next_message_id()
         self.receiverID = receiverID
         self._message_type = message_type
+        if self.ttl is not None:
+            self.deadline = util.get_time() + self.ttl
+    def set_ttl(self, seconds):
+        '''drops the message if it is not dispatched within ``seconds`` from now'''
+        self.deadline = util.get_time() + seconds
     def __repr__(self):
         return 'Message %s %s' % (self.message_type, self.gid)
     @property
@@ -68,6 +478,12 @@ class Message(object):
         return self._message_type or self.__class__.__name__
     def get_sender(self):
         return self.sender
+    def get_conflation_key(self):
+        '''messages queued with the same key replace each other, only the latest one is dispatched
+        
+           the key is made of the message type, the designated receiver and the properties named in ``conflation_key``
+        '''
+        return (self.message_type, self.receiverID) + tuple([self.get_property(name) for name in self.conflation_key])
     def lazy_set_property(self, name, value):
         '''this does same as set_property, without validation'''
         self._properties[name] = value
@@ -111,23 +527,73 @@ class Message(object):
         '''
         pass
     def __getstate__(self):
-        return dict( [(i,v) for i,v in self.__dict__.items() if i in ('gid', 'properties', '_properties', 'receiverID')] )
+        return dict( [(i,v) for i,v in self.__dict__.items() if i in ('gid', 'properties', '_properties', 'receiverID', '_message_type')] )
     def __setstate__(self, d):
         self.__dict__.update(d)
 
+class Message(MessageBase):
+    '''generic message class'''
+
 class MessageManager(util.ProcessLocalSingleton):
     '''generic message manager singleton class that game object manager inherits from'''
     def init(self):
-        self.message_types = []
+        self.message_types = set()
         # WildCardMessageType is the wild card message type, 
         # all receivers that subscribe to this receive all messages
         # however these type of receivers cannot consume the message
         self.message_receiver_map = {WildCardMessageType: set()}
+        # bound handlers resolved at subscription time: msgType -> {receiver: handler}
+        self.message_handler_map = {}
+        # dispatch tables built from the maps above, invalidated on (un)subscription
+        self._dispatch_table = {}
+        self._wildcard_dispatch_table = {}
+        # number of message types each dispatch cache holds, a full cache is emptied and built again on demand
+        self.dispatch_cache_size = 4096
+        # segment pattern subscriptions ("market.*.AAPL"), and the handlers they resolve to per message type
+        self.topic_trie = TopicTrie()
+        self._pattern_table = {}
         
-        # double buffering to avoid infinite cycles
-        self.active_queue = collections.deque()
-        self.processing_queue = collections.deque()
-        self.coroutines = []
+        # double buffering to avoid infinite cycles, one pair of queues per priority lane
+        self._reset_queues()
+        self._reset_scheduler()
+        # optional callable invoked whenever a message is queued, used by event loop integrations
+        self._wakeup = None
+        # same, for messages posted from other threads, see post_message
+        self._ingress_wakeup = None
+        self.ingress_event = None
+        self._reset_queue_limits()
+        # dispatch statistics, None unless enable_metrics is called
+        self.metrics = None
+        # slow handler profiler, None unless enable_profiling is called
+        self.profiler = None
+        # area of interest of receivers, None until ActorManager.set_interest is called
+        self.interest_grid = None
+        self._spatial_tables = {}
+        # pools of handlers marked with "offload", created on first use, see set_offload_pools
+        self.offload_pools = {}
+        self.offload_pool_sizes = {OFFLOAD_THREAD: None, OFFLOAD_PROCESS: None}
+        self.offload_limit = 1
+        self._offload_states = {}
+    def _reset_queue_limits(self):
+        # message type (None for the whole manager) -> _QueueLimit
+        self.queue_limits = {}
+        # number of queued messages of each type that has a limit
+        self._type_counts = {}
+        self.high_water_mark = None
+        self.overflow_counts = {}
+        self.dropped_counts = {}
+        # messages that were past their deadline when dequeued, per message type
+        self.expired_counts = {}
+        self.expiry_callback = None
+    def _reset_scheduler(self):
+        # coroutines to be advanced once on the next tick
+        self.coroutines = collections.deque()
+        # heap of [due time, sequence, callback, args], see call_at
+        self._timers = []
+        self._timer_sequence = itertools.count()
+        # coroutines parked until a message is dispatched: message type/replied gid -> [_Waiter]
+        self._message_waiters = {}
+        self._reply_waiters = {}
     def validate_type(self, message_type):
         if not message_type:
             return False
@@ -141,11 +607,87 @@ class MessageManager(util.ProcessLocalSingleton):
         if it finished, return None
         else, return the coroutine itself
         '''
+        if self.resume_coroutine(c):
+            return c
+        return None
+    def resume_coroutine(self, c, value=None):
+        '''
+        sends ``value`` to the coroutine and parks it according to the directive it yields:
+        
+            - `Sleep`: in the timer heap
+            - `WaitForMessage`, `WaitForReply`: in the wait index of the message type or gid
+            - anything else: advanced again on the next tick
+        
+        :Return:
+            - true: if the coroutine is still running
+            - false: if it finished
+        '''
         try:
-            c.next()
+            directive = c.send(value)
         except StopIteration:
-            return None
-        return c
+            return False
+        directive_type = type(directive)
+        if directive_type is Sleep:
+            self.call_at(util.get_time() + directive.seconds, self.resume_coroutine, c)
+        elif directive_type is WaitForMessage:
+            self._park(c, self._message_waiters, directive.message_type, directive.timeout)
+        elif directive_type is WaitForReply:
+            self._park(c, self._reply_waiters, directive.gid, directive.timeout)
+        else:
+            self.coroutines.append(c)
+        return True
+    def _park(self, c, index, key, timeout):
+        waiter = _Waiter(c, index, key)
+        index.setdefault(key, []).append(waiter)
+        if timeout is not None:
+            waiter.timer = self.call_at(util.get_time() + timeout, self._expire_waiter, waiter)
+    def _expire_waiter(self, waiter):
+        waiters = waiter.index[waiter.key]
+        waiters.remove(waiter)
+        if not waiters:
+            del waiter.index[waiter.key]
+        self.resume_coroutine(waiter.coroutine)
+    def _wake_waiters(self, index, key, msg):
+        '''resumes every coroutine waiting on ``key`` with the message'''
+        for waiter in index.pop(key, ()):
+            if waiter.timer:
+                self.cancel_timer(waiter.timer)
+            self.resume_coroutine(waiter.coroutine, msg)
+    def next_tick_delay(self):
+        '''
+        returns how long the owner of the tick loop may wait before calling ``tick`` again
+        
+        :Return:
+            - 0: if messages or coroutines are ready to be processed
+            - seconds until the earliest timer is due
+            - None: if nothing is pending
+        '''
+        if self.coroutines or self._ingress or self.get_message_count():
+            return 0
+        if self._timers:
+            return max(0, self._timers[0][0] - util.get_time())
+        return None
+    def call_at(self, due, callback, *args):
+        '''
+        calls ``callback(*args)`` during the first tick at or after ``due`` (in ``util.get_time`` seconds)
+        
+        :Return:
+            - a timer handle that can be passed to ``cancel_timer``
+        '''
+        timer = [due, self._timer_sequence.next(), callback, args]
+        heapq.heappush(self._timers, timer)
+        if self._wakeup is not None:
+            self._wakeup()
+        return timer
+    def cancel_timer(self, timer):
+        '''cancels a timer returned by ``call_at``, the heap entry is discarded when it comes due'''
+        timer[2] = None
+    def _run_timers(self, now):
+        timers = self._timers
+        while timers and timers[0][0] <= now:
+            due, sequence, callback, args = heapq.heappop(timers)
+            if callback is not None:
+                callback(*args)
     def tick(self, max_time=None):
         '''
         Process queued messages.
@@ -158,53 +700,265 @@ class MessageManager(util.ProcessLocalSingleton):
             - true: if all messages ready for processing were completed
             - false: otherwise (i.e.: processing took more than max_time)
         '''
-        # swap queues and clear the active_queue
-        self.active_queue, self.processing_queue = self.processing_queue, self.active_queue
-        self.active_queue.clear()
-        coroutines_to_add = []
+        # swap queues, the active queues are left empty by the previous tick
         startTime = time.time()
+        metrics = self.metrics
+        if metrics is not None:
+            phase_start = util.get_time()
+            dispatch = self._measured_dispatch
+        else:
+            dispatch = self._dispatch
         
-        # first process each existing coroutine once exactly
-        self.coroutines = [x for x in self.coroutines if self.process_coroutine(x)]
-        
-        while len(self.processing_queue):
-            # always pop the message off the queue, if there is no listeners for this message yet
-            # then the message will be dropped off the queue
-            msg = self.processing_queue.popleft()
-            # for receivers that handle all messages let them handle this
-            for r in self.message_receiver_map[WildCardMessageType]:
-                res = r.handle_message(msg)
-                # coroutines will be run 
-                if inspect.isgenerator(res):
-                    c = self.process_coroutine(res)
-                    if c:
-                        coroutines_to_add.append(c)
-            # now pass msg to message receivers that subscribed to this message type
-            for r in self.message_receiver_map.get(msg.message_type, []):
-                if not self.designated_to_handle(r, msg):
-                    continue
-                res = r.handle_message(msg)
-                if inspect.isgenerator(res):
-                    c = self.process_coroutine(res)
-                    if c:
-                        coroutines_to_add.append(c)
-                else:
-                    # finish this message if it was handled or had designated receiver
-                    if res or msg.receiverID:
+        # deliver delayed messages and wake up sleeping and timed out coroutines, 
+        # timers run before swapping so that messages that came due are processed on this tick
+        if self._timers and self._timers[0][0] <= util.get_time():
+            self._run_timers(util.get_time())
+        if self._ingress:
+            self._drain_ingress()
+        self.active_queues, self.processing_queues = self.processing_queues, self.active_queues
+        # then process each coroutine that is ready once exactly, coroutines readied from here on wait for the next tick
+        for i in xrange(len(self.coroutines)):
+            self.resume_coroutine(self.coroutines.popleft())
+        if metrics is not None:
+            phase_start = metrics.add_phase('coroutines', phase_start)
+        
+        # drain lanes from the highest priority down, all sharing the same time budget
+        # lanes created while dispatching replace self.priorities, they are only picked up next tick
+        timed_out = False
+        # triggered messages are collected into this tick's batches instead of flushing them early
+        self._dispatching = True
+        try:
+            for priority in self.priorities:
+                queue = self.processing_queues[priority]
+                while queue:
+                    # always pop the message off the queue, if there is no listeners for this message yet
+                    # then the message will be dropped off the queue
+                    msg = queue.popleft()
+                    if self._type_counts and msg.message_type in self._type_counts:
+                        self._type_counts[msg.message_type] -= 1
+                    # conflated messages hold the place of the latest message queued with the same key
+                    if msg.conflation_key is not None:
+                        msg = self._conflated.pop(msg.get_conflation_key(), msg)
+                    if msg.deadline is not None and msg.deadline < util.get_time():
+                        self._expire(msg)
+                        continue
+                    dispatch(msg)
+                    if max_time and time.time() - startTime > max_time:
+                        timed_out = True
                         break
-            if max_time and time.time() - startTime > max_time:
-                break
-            
-        # queue up all pending coroutines
-        self.coroutines.extend(coroutines_to_add)
+                if timed_out:
+                    break
+            # batch handlers run once all messages of the tick were dispatched
+            if self._pending_batches:
+                self._flush_batches()
+        finally:
+            self._dispatching = False
+        if metrics is not None:
+            metrics.add_phase('dispatch', phase_start)
+            metrics.ticks += 1
             
-        flushed = len(self.processing_queue) == 0
-        # push any left over messages to the active queue
-        # bottom-up on the processQueue and push to the front of active_queue
-        if not flushed:
-            while len(self.processing_queue):
-                self.active_queue.appendleft(self.processing_queue.pop())
+        flushed = True
+        # push any left over messages to the front of the active queue of the same lane
+        for priority, queue in self.processing_queues.iteritems():
+            if queue:
+                flushed = False
+                self.active_queues[priority].extendleft(reversed(queue))
+                queue.clear()
         return flushed
+    def _dispatch(self, msg):
+        '''delivers a single message to waiting coroutines, wild card receivers and then its subscribers'''
+        if self._message_waiters:
+            self._wake_waiters(self._message_waiters, msg.message_type, msg)
+        if self._reply_waiters and msg.reply_to is not None:
+            self._wake_waiters(self._reply_waiters, msg.reply_to, msg)
+        # for receivers that handle all messages let them handle this
+        for r, handler in self._get_wildcard_dispatch(msg.message_type):
+            res = handler(msg)
+            # coroutines will be run 
+            if res and res is not True:
+                self._start_result(handler, res)
+        # designated messages go straight to their receiver
+        if msg.receiverID:
+            handler = self.get_designated_handler(msg)
+            if handler:
+                res = handler(msg)
+                if res and res is not True:
+                    self._start_result(handler, res)
+            return
+        # now pass msg to message receivers that subscribed to this message type
+        if self.interest_grid is not None and msg.location is not None:
+            table = self._get_spatial_dispatch(msg)
+        else:
+            table = self._get_dispatch(msg.message_type)
+        for r, handler in table:
+            res = handler(msg)
+            # finish this message if it was handled, coroutines and awaitables do not consume it
+            if res:
+                if res is True or not self._start_result(handler, res):
+                    break
+    def _measured_dispatch(self, msg):
+        '''_dispatch, recording the queue latency and dispatch time of the message'''
+        start = util.get_time()
+        queued_at = getattr(msg, 'queued_at', None)
+        self._dispatch(msg)
+        latency = None
+        if queued_at is not None:
+            latency = start - queued_at
+        self.metrics.add_message(msg.message_type, latency, util.get_time() - start)
+    def enable_metrics(self, sample_size=1024):
+        '''
+        starts collecting dispatch statistics, see get_metrics
+        
+        :Parameters:
+            - `sample_size`: number of most recent queue latencies kept per message type for the percentiles
+        '''
+        self.metrics = Metrics(sample_size)
+    def disable_metrics(self):
+        self.metrics = None
+    def get_metrics(self):
+        '''
+        returns a snapshot of the dispatch statistics, None if metrics are not enabled
+        
+        the snapshot holds per message type the dispatch count, total handler time and the p50/p99 latency
+        from ``queue_message`` to dispatch, the time spent in each tick phase and the queue depth high water mark
+        '''
+        if self.metrics is None:
+            return None
+        return self.metrics.snapshot()
+    def enable_profiling(self, threshold, ring_size=1000, sample_stacks=False):
+        '''
+        times every handler (and actor update) against ``threshold`` seconds, see get_slow_report
+        
+        :Parameters:
+            - `threshold`: calls taking at least this long are recorded
+            - `ring_size`: how many slow calls are kept
+            - `sample_stacks`: optional.  records the stack of calls that run past the threshold, using a watchdog thread
+        '''
+        self.disable_profiling()
+        self.profiler = Profiler(threshold, ring_size, sample_stacks)
+        self._dispatch_table.clear()
+        self._wildcard_dispatch_table.clear()
+    def disable_profiling(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+            self._dispatch_table.clear()
+            self._wildcard_dispatch_table.clear()
+    def get_slow_calls(self):
+        '''returns the recorded slow calls as (class name, message type or "update", duration, stack) tuples'''
+        if self.profiler is None:
+            return []
+        return list(self.profiler.slow_calls)
+    def get_slow_report(self, n=10):
+        '''returns the top ``n`` slow receiver class and message type pairs, aggregated across ticks'''
+        if self.profiler is None:
+            return []
+        return self.profiler.report(n)
+    def _start_result(self, handler, res):
+        '''
+        starts what a handler returned: an awaitable goes to the event loop, a generator is resumed as a pysage coroutine
+        
+        :Return:
+            - true: if the result was either, it does not consume the message
+            - false: otherwise
+        '''
+        # checked first, trollius coroutines are generators too
+        if self._start_awaitable(handler, res):
+            return True
+        if inspect.isgenerator(res):
+            self.resume_coroutine(res)
+            return True
+        return False
+    def _start_awaitable(self, handler, res):
+        '''hands an awaitable returned by a handler to an event loop, returns true if it was taken
+        
+           the base manager has no event loop, see ActorManager.attach_event_loop
+        '''
+        return False
+    def get_designated_handler(self, msg):
+        '''returns the cached handler of the subscriber designated by ``msg.receiverID``, None if there is none
+        
+           this walks the subscribers of the message type asking ``designated_to_handle``.  
+           managers that keep an id registry should override it with a direct lookup.
+        '''
+        for r, handler in self._get_dispatch(msg.message_type):
+            if self.designated_to_handle(r, msg):
+                return handler
+        return None
+    def _get_dispatch(self, msgType):
+        '''returns the cached (receiver, handler) pairs subscribed to the message type, pattern subscribers included
+        
+           the dispatch caches hold at most ``dispatch_cache_size`` message types each, see _cache_dispatch
+        '''
+        table = self._dispatch_table.get(msgType)
+        if table is None:
+            handlers = self.message_handler_map.get(msgType, {})
+            pairs = handlers.items()
+            if self.topic_trie:
+                pairs.extend((r, h) for r, h in self._get_pattern_handlers(msgType).iteritems() if r not in handlers)
+            table = self._cache_dispatch(self._dispatch_table, msgType, self._profiled(msgType, pairs))
+        return table
+    def _get_pattern_handlers(self, msgType):
+        '''returns the cached {receiver: handler} of the pattern subscribers matching the message type
+        
+           a receiver's handler for the concrete type wins over its handler for the pattern.
+        '''
+        table = self._pattern_table.get(msgType)
+        if table is None:
+            table = self._cache_dispatch(self._pattern_table, msgType, {})
+            for r, pattern in self.topic_trie.match(msgType):
+                if getattr(r, batch_handler_name(msgType), None) is None and r.get_handler(msgType) == r.handle_message:
+                    handler = self.message_handler_map[pattern][r]
+                else:
+                    handler = self._resolve_handler(r, msgType)
+                table.setdefault(r, handler)
+        return table
+    def _get_spatial_dispatch(self, msg):
+        '''
+        returns the (receiver, handler) pairs a message with a location is delivered to: 
+        the subscribers whose interest region contains the location, then the subscribers without one
+        '''
+        position = msg.get_property(msg.location)
+        table = self._get_dispatch(msg.message_type)
+        if position is None:
+            return table
+        # split of the dispatch table, rebuilt along with it
+        split = self._spatial_tables.get(msg.message_type)
+        if split is None or split[0] is not table:
+            grid = self.interest_grid
+            split = self._cache_dispatch(self._spatial_tables, msg.message_type, (table, dict(table), [(r, h) for r, h in table if r not in grid]))
+        handlers = split[1]
+        return [(r, handlers[r]) for r in self.interest_grid.query(position) if r in handlers] + split[2]
+    def _get_wildcard_dispatch(self, msgType):
+        '''returns the cached (receiver, handler) pairs of wild card receivers for the message type'''
+        table = self._wildcard_dispatch_table.get(msgType)
+        if table is None:
+            table = self._cache_dispatch(self._wildcard_dispatch_table, msgType, self._profiled(msgType, [(r, self._resolve_handler(r, msgType)) for r in self.message_receiver_map[WildCardMessageType]]))
+        return table
+    def _cache_dispatch(self, cache, msgType, table):
+        '''stores the table of the message type in a per type dispatch cache and returns it
+        
+           ad hoc or topic named message types would grow the caches without bound,
+           a cache that reached ``dispatch_cache_size`` message types is emptied first
+        '''
+        if len(cache) >= self.dispatch_cache_size:
+            cache.clear()
+        cache[msgType] = table
+        return table
+    def _profiled(self, msgType, pairs):
+        '''while profiling, dispatch tables are built with timed handlers so the regular path stays untouched'''
+        if self.profiler is not None:
+            return [(r, self.profiler.wrap(r, msgType, handler)) for r, handler in pairs]
+        return list(pairs)
+    def _invalidate_dispatch(self, msgType):
+        if msgType == WildCardMessageType:
+            self._wildcard_dispatch_table.clear()
+        elif is_topic_pattern(msgType):
+            # a pattern may match any number of message types
+            self._pattern_table.clear()
+            self._dispatch_table.clear()
+        else:
+            self._dispatch_table.pop(msgType, None)
     def designated_to_handle(self, r, m):
         '''this method is called before a receiver handles a message
         
@@ -230,18 +984,30 @@ class MessageManager(util.ProcessLocalSingleton):
         if not self.validate_type(msgType):
             return False
         success = False
-        for i in [x for x in self.active_queue if x.message_type == msgType]:
-            # queue.remove(v) only available in python 2.5
-            self.active_queue.remove(i)
-            success = True
-            if not abortAll:
-                return True
+        for priority in self.priorities:
+            queue = self.active_queues[priority]
+            for i in [x for x in queue if x.message_type == msgType]:
+                # queue.remove(v) only available in python 2.5
+                queue.remove(i)
+                self._forget(i)
+                success = True
+                if not abortAll:
+                    return True
         return success
-    def queue_message(self, msg):
+    def queue_message(self, msg, priority=None, delay=None, deliver_at=None, ttl=None):
         '''asychronously queues a message to be processed
         
+           :Parameters:
+               - `msg`: the message to be queued
+               - `priority`: optional.  the lane to queue the message in, defaults to the message's ``priority``.
+                 lanes with a higher priority are processed first on each tick.  a message that replaces a queued
+                 message with the same conflation key stays in the lane of the queued message
+               - `delay`: optional.  seconds to hold the message before queuing it
+               - `deliver_at`: optional.  time (in ``util.get_time`` seconds) to hold the message until
+               - `ttl`: optional.  the message is dropped if it is not dispatched within ``ttl`` seconds from now
+        
            :Return: 
-               - true: if the message was added to the processing queue
+               - true: if the message was added to the processing queue (or scheduled to be)
                - false: otherwise.
         '''
         if not self.validate_message(msg):
@@ -252,8 +1018,329 @@ class MessageManager(util.ProcessLocalSingleton):
         # if not self.message_receiver_map.has_key(msg.message_type) and not self.message_receiver_map[WildCardMessageType]:
         #     return False
         # else:
-        self.active_queue.append(msg)
+        if ttl is not None:
+            msg.set_ttl(ttl)
+        if delay is not None or deliver_at is not None:
+            if deliver_at is None:
+                deliver_at = util.get_time() + delay
+            self.call_at(deliver_at, self._queue_validated_message, msg, priority)
+            return True
+        return self._queue_validated_message(msg, priority)
+    def _queue_validated_message(self, msg, priority):
+        if msg.conflation_key is not None:
+            key = msg.get_conflation_key()
+            if key in self._conflated:
+                # replace the queued message in place
+                self._conflated[key] = msg
+                return True
+        if self.queue_limits:
+            limit = self._admit(msg)
+            if limit is not None:
+                return self._overflow(msg, limit)
+        if msg.conflation_key is not None:
+            self._conflated[key] = msg
+        if priority is None:
+            priority = msg.priority
+        try:
+            self.active_queues[priority].append(msg)
+        except KeyError:
+            self._add_lane(priority).append(msg)
+        if self.metrics is not None:
+            msg.queued_at = util.get_time()
+            self.metrics.add_queue_depth(self.get_message_count())
+        if self._wakeup is not None:
+            self._wakeup()
         return True
+    def post_message(self, msg, priority=None):
+        '''thread safe version of queue_message, any number of threads may post while another one ticks
+        
+           the message is queued on the next tick, by the thread that ticks.  posting does not take a lock, 
+           appending to a deque is atomic.
+           
+           :Parameters:
+               - `msg`: the message to be queued
+               - `priority`: optional.  the lane to queue the message in, defaults to the message's ``priority``
+        '''
+        self._ingress.append((self.queue_message, (msg, priority)))
+        self._notify_ingress()
+    def post_messages(self, msgs, priority=None):
+        '''thread safe batch version of post_message, the messages are handed over in a single append'''
+        queue_message = self.queue_message
+        self._ingress.extend([(queue_message, (msg, priority)) for msg in msgs])
+        self._notify_ingress()
+    def _post_call(self, func, *args):
+        '''thread safe, calls ``func(*args)`` from the thread that ticks, on the next tick'''
+        self._ingress.append((func, args))
+        self._notify_ingress()
+    def _notify_ingress(self):
+        if self.ingress_event is not None:
+            self.ingress_event.set()
+        if self._ingress_wakeup is not None:
+            self._ingress_wakeup()
+    def get_ingress_event(self):
+        '''returns a threading.Event set whenever a message is posted, for tick loops that wait between ticks
+        
+           the event is cleared by the tick that picks up the posted messages.
+        '''
+        if self.ingress_event is None:
+            self.ingress_event = threading.Event()
+        return self.ingress_event
+    def _drain_ingress(self):
+        if self.ingress_event is not None:
+            self.ingress_event.clear()
+        # only what was posted so far, producers may keep appending while we pop
+        ingress = self._ingress
+        for i in xrange(len(ingress)):
+            func, args = ingress.popleft()
+            func(*args)
+    def set_offload_pools(self, threads=None, processes=None, max_per_receiver=None):
+        '''
+        configures the pools that run handlers marked with ``offload``
+        
+        :Parameters:
+            - `threads`: optional.  number of worker threads
+            - `processes`: optional.  number of worker processes
+            - `max_per_receiver`: optional.  number of offloaded calls of one receiver that may run at once, 
+              1 by default.  results are released in dispatch order regardless
+        '''
+        for kind, size in ((OFFLOAD_THREAD, threads), (OFFLOAD_PROCESS, processes)):
+            if size is not None and size != self.offload_pool_sizes[kind]:
+                self.offload_pool_sizes[kind] = size
+                # running calls finish in the old pool, new ones go to a pool of the new size
+                pool = self.offload_pools.pop(kind, None)
+                if pool is not None:
+                    pool.shutdown(wait=False)
+        if max_per_receiver is not None:
+            self.offload_limit = max_per_receiver
+    def shutdown_offload_pools(self, wait=True):
+        '''shuts the offload pools down, results that come back later are dropped'''
+        for pool in self.offload_pools.values():
+            pool.shutdown(wait=wait)
+        self.offload_pools = {}
+        self._offload_states = {}
+    def _get_offload_pool(self, kind):
+        pool = self.offload_pools.get(kind)
+        if pool is None:
+            if kind == OFFLOAD_PROCESS:
+                pool = futures.ProcessPoolExecutor(self.offload_pool_sizes[kind])
+            else:
+                pool = futures.ThreadPoolExecutor(self.offload_pool_sizes[kind] or 4)
+            self.offload_pools[kind] = pool
+        return pool
+    def _resolve_handler(self, receiver, msgType):
+        '''returns the callable the dispatch tables hold for the receiver and message type
+        
+           a batch handler ("handle_batch_<type>") takes precedence over the handler of single messages,
+           it always runs in the tick and can not be offloaded
+        '''
+        batch_handler = getattr(receiver, batch_handler_name(msgType), None)
+        if batch_handler is not None:
+            if getattr(batch_handler, 'offload', None):
+                raise TypeError('Batch handler %s of %s can not be offloaded' % (batch_handler_name(msgType), receiver.__class__.__name__))
+            return self._wrap_handler(receiver, _BatchCollector(self, receiver, batch_handler, msgType))
+        return self._wrap_handler(receiver, receiver.get_handler(msgType))
+    def _flush_batches(self):
+        '''calls the batch handlers that collected messages, in the order their first message was dispatched
+        
+           the handlers are timed like the handlers of single messages, when metrics or profiling are enabled
+        '''
+        while self._pending_batches:
+            pending = self._pending_batches
+            self._pending_batches = []
+            for collector in pending:
+                metrics = self.metrics
+                if metrics is not None:
+                    start = util.get_time()
+                if self.profiler is not None:
+                    res = self.profiler.call(collector.receiver, collector.message_type, collector.flush)
+                else:
+                    res = collector.flush()
+                if metrics is not None:
+                    metrics.add_handler_time(collector.message_type, util.get_time() - start)
+                if res and res is not True:
+                    self._start_result(collector.handler, res)
+    def _wrap_handler(self, receiver, handler):
+        '''returns the callable the dispatch tables hold for a receiver's handler
+        
+           that is the handler itself, or its offloading stand in if it was marked with "offload"
+        '''
+        if getattr(handler, 'offload', None) is None:
+            return handler
+        return _OffloadedHandler(self, receiver, handler)
+    def _submit_offloaded(self, receiver, handler, msg):
+        if not FUTURES_AVAILABLE:
+            self._release_offloaded(handler, handler(msg))
+            return
+        state = self._offload_states.get(receiver)
+        if state is None:
+            state = self._offload_states[receiver] = _OffloadState()
+        sequence = state.next_sequence
+        state.next_sequence += 1
+        if state.running < self.offload_limit:
+            self._start_offloaded(receiver, state, handler, msg, sequence)
+        else:
+            state.backlog.append((handler, msg, sequence))
+    def _start_offloaded(self, receiver, state, handler, msg, sequence):
+        if handler.offload == OFFLOAD_PROCESS:
+            future = self._get_offload_pool(OFFLOAD_PROCESS).submit(_run_in_process, type(receiver), handler.__name__, msg)
+        else:
+            future = self._get_offload_pool(OFFLOAD_THREAD).submit(handler, msg)
+        state.running += 1
+        # completion is reported from a pool thread, it is handed back through the ingress
+        future.add_done_callback(lambda f: self._post_call(self._offload_done, receiver, handler, sequence, f))
+    def _offload_done(self, receiver, handler, sequence, future):
+        state = self._offload_states.get(receiver)
+        if state is None:
+            return
+        state.running -= 1
+        state.done[sequence] = (handler, future)
+        while state.next_release in state.done:
+            handler, future = state.done.pop(state.next_release)
+            state.next_release += 1
+            if future.exception() is not None:
+                logger.error('offloaded handler %s failed: %s' % (handler, future.exception()))
+            else:
+                self._release_offloaded(handler, future.result())
+        while state.backlog and state.running < self.offload_limit:
+            self._start_offloaded(receiver, state, *state.backlog.popleft())
+        if not state.running and not state.backlog and not state.done:
+            del self._offload_states[receiver]
+    def _release_offloaded(self, handler, result):
+        '''queues the messages returned by an offloaded handler'''
+        if isinstance(result, MessageBase):
+            self.queue_message(result)
+        elif isinstance(result, (list, tuple)):
+            for msg in result:
+                self.queue_message(msg)
+    def set_queue_capacity(self, capacity, message_type=None, policy=OVERFLOW_REJECT, callback=None, high_water_mark=None):
+        '''
+        bounds the number of queued messages, of the whole manager or of one message type
+        
+        :Parameters:
+            - `capacity`: the maximum number of queued messages, None removes the limit
+            - `message_type`: optional.  limit only messages of this type
+            - `policy`: what ``queue_message`` does with a message that does not fit:
+            
+                - OVERFLOW_REJECT: drops it and returns False
+                - OVERFLOW_DROP_NEWEST: drops it silently and returns True
+                - OVERFLOW_DROP_OLDEST: drops the oldest queued message (of the limited type) to make room
+                - OVERFLOW_SIGNAL: drops it, calls ``callback(msg)`` and returns what the callback returns
+            - `high_water_mark`: optional.  manager wide only, the queue length at which the manager stops 
+              reading from its transports (defaults to ``capacity``)
+        '''
+        if policy == OVERFLOW_SIGNAL and not callback:
+            raise ValueError('policy "%s" requires a callback' % policy)
+        if capacity is None:
+            self.queue_limits.pop(message_type, None)
+            self._type_counts.pop(message_type, None)
+        else:
+            self.queue_limits[message_type] = _QueueLimit(capacity, policy, callback)
+            if message_type is not None:
+                # the messages a tick in progress did not dispatch yet are counted too, they are uncounted at dispatch
+                queues = self.active_queues.values() + self.processing_queues.values()
+                self._type_counts[message_type] = sum(1 for q in queues for m in q if m.message_type == message_type)
+        if message_type is None:
+            self.high_water_mark = high_water_mark or capacity
+    def is_over_high_water_mark(self):
+        '''returns true if the queue is too long to read more messages from the transports'''
+        return self.high_water_mark is not None and self.get_message_count() >= self.high_water_mark
+    def get_queue_stats(self):
+        '''returns the queue length along with overflow, drop and expiry counters per message type'''
+        return {'queued': self.get_message_count(),
+                'overflows': dict(self.overflow_counts),
+                'dropped': dict(self.dropped_counts),
+                'expired': dict(self.expired_counts)}
+    def set_expiry_callback(self, callback):
+        '''``callback(msg)`` is called with every message dropped because its deadline passed, None to stop'''
+        self.expiry_callback = callback
+    def _expire(self, msg):
+        self.expired_counts[msg.message_type] = self.expired_counts.get(msg.message_type, 0) + 1
+        if self.expiry_callback is not None:
+            self.expiry_callback(msg)
+    def _admit(self, msg):
+        '''
+        counts the message against the limits, returns the limit it does not fit in or None
+        
+        both limits are checked before the oldest messages are dropped to make room, 
+        so that nothing is dropped for a message that is rejected
+        '''
+        message_type = msg.message_type
+        victims = []
+        freed = 0
+        limit = self.queue_limits.get(message_type)
+        if limit and self._type_counts[message_type] >= limit.capacity:
+            # the messages a tick in progress did not dispatch yet are the oldest of the type
+            victim = limit.policy == OVERFLOW_DROP_OLDEST and (self._find_oldest(message_type, lanes=self.processing_queues) or
+                                                               self._find_oldest(message_type))
+            if not victim:
+                return limit
+            victims.append(victim)
+            # dropping a queued message of the type also makes room in the whole queue
+            freed = len([q for q in self.active_queues.itervalues() if q is victim[0]])
+        limit = self.queue_limits.get(None)
+        if limit and self.get_message_count() - freed >= limit.capacity:
+            victim = limit.policy == OVERFLOW_DROP_OLDEST and self._find_oldest(None, victims and victims[0][1])
+            if not victim:
+                return limit
+            victims.append(victim)
+        for queue, victim in victims:
+            self._drop(queue, victim)
+        if message_type in self._type_counts:
+            self._type_counts[message_type] += 1
+        return None
+    def _overflow(self, msg, limit):
+        '''applies the overflow policy of the limit to a message that did not fit'''
+        message_type = msg.message_type
+        self.overflow_counts[message_type] = self.overflow_counts.get(message_type, 0) + 1
+        self.dropped_counts[message_type] = self.dropped_counts.get(message_type, 0) + 1
+        if limit.policy == OVERFLOW_SIGNAL:
+            return limit.callback(msg)
+        return limit.policy == OVERFLOW_DROP_NEWEST
+    def _find_oldest(self, message_type, exclude=None, lanes=None):
+        '''
+        returns (queue, message) of the oldest message (of the given type) other than ``exclude``, lowest priority lane first
+        
+        the queued messages are searched, or the given ``lanes`` such as the processing queues of a tick in progress
+        '''
+        if lanes is None:
+            lanes = self.active_queues
+        for priority in reversed(self.priorities):
+            queue = lanes[priority]
+            for msg in queue:
+                if (message_type is None or msg.message_type == message_type) and msg is not exclude:
+                    return queue, msg
+        return None
+    def _drop(self, queue, msg):
+        '''drops a queued message to make room for a new one'''
+        queue.remove(msg)
+        self._forget(msg)
+        self.overflow_counts[msg.message_type] = self.overflow_counts.get(msg.message_type, 0) + 1
+        self.dropped_counts[msg.message_type] = self.dropped_counts.get(msg.message_type, 0) + 1
+    def _forget(self, msg):
+        '''bookkeeping for a queued message that is removed without being dispatched'''
+        if msg.message_type in self._type_counts:
+            self._type_counts[msg.message_type] -= 1
+        if msg.conflation_key is not None:
+            self._conflated.pop(msg.get_conflation_key(), None)
+    def _add_lane(self, priority):
+        '''creates the queues for a new priority lane and returns its active queue'''
+        self.processing_queues[priority] = collections.deque()
+        queue = self.active_queues[priority] = collections.deque()
+        # rebinding rather than mutating keeps a tick that is iterating the lanes safe
+        self.priorities = sorted(self.active_queues, reverse=True)
+        return queue
+    def _reset_queues(self):
+        # conflation key -> latest message, see Message.get_conflation_key
+        self._conflated = {}
+        self.active_queues = {}
+        self.processing_queues = {}
+        self.priorities = []
+        self._add_lane(0)
+        # batch handlers that collected messages during this tick's dispatch
+        self._pending_batches = []
+        self._dispatching = False
+        # (callable, args) posted from other threads, see post_message and _post_call
+        self._ingress = collections.deque()
     def trigger(self, msg):
         '''
         same as queue_message, except that this is synchronous
@@ -270,12 +1357,20 @@ class MessageManager(util.ProcessLocalSingleton):
         if not self.validate_type(msg.message_type):
             return False
         # for receivers that register to all events, send the message to them
-        map(lambda x: x.handle_message(msg), self.message_receiver_map[WildCardMessageType])
+        for r, handler in self._get_wildcard_dispatch(msg.message_type):
+            handler(msg)
         # Now loop thru the receivers that actually subscribed to this particular message type
+        if self.interest_grid is not None and msg.location is not None:
+            table = self._get_spatial_dispatch(msg)
+        else:
+            table = self._get_dispatch(msg.message_type)
         processed = False
-        for r in self.message_receiver_map.get(msg.message_type, []):
-            if r.handle_message(msg):
+        for r, handler in table:
+            if handler(msg):
                 processed = True
+        # a synchronous message does not wait for the end of the tick, unless it is triggered during one
+        if self._pending_batches and not self._dispatching:
+            self._flush_batches()
         return processed
     def add_receiver(self, receiver, msgType):
         '''
@@ -285,15 +1380,25 @@ class MessageManager(util.ProcessLocalSingleton):
             - true: if success
             - false: otherwise
         '''
+        return self.add_receivers([receiver], msgType)
+    def add_receivers(self, receivers, msgType):
+        '''registers the receivers with the message type, the dispatch table is invalidated once for all of them'''
         if not self.validate_type(msgType):
             return False
-        # if this is a new type, add to message types and register receiver
+        if is_topic_pattern(msgType):
+            for receiver in receivers:
+                self.topic_trie.add(msgType, receiver)
+        # if this is a new type, add to message types
         if not msgType in self.message_types:
-            self.message_types.append(msgType)
-            self.message_receiver_map[msgType] = set([receiver])
-        # known msg type, just register receiver
-        else:
-            self.message_receiver_map[msgType].add(receiver)
+            self.message_types.add(msgType)
+            self.message_receiver_map[msgType] = set()
+        self.message_receiver_map[msgType].update(receivers)
+        # wild card receivers have their handlers resolved per message type on first dispatch
+        if msgType != WildCardMessageType:
+            handlers = self.message_handler_map.setdefault(msgType, {})
+            for receiver in receivers:
+                handlers[receiver] = self._resolve_handler(receiver, msgType)
+        self._invalidate_dispatch(msgType)
         return True
     def remove_receiver(self, receiver, msgType):
         '''un-register the receiver with the message type
@@ -302,29 +1407,84 @@ class MessageManager(util.ProcessLocalSingleton):
                - true: if successfully unregistered
                - false: if the pair is not found in registry
         '''
+        return self.remove_receivers([receiver], msgType) == 1
+    def remove_receivers(self, receivers, msgType):
+        '''un-registers the receivers with the message type, returns how many of them were registered'''
         if not self.validate_type(msgType):
-            return False
-        if not receiver in self.message_receiver_map[msgType]:
-            return False
-        else:
-            self.message_receiver_map[msgType].remove(receiver)
-            return True
+            return 0
+        registered = self.message_receiver_map.get(msgType)
+        if not registered:
+            return 0
+        handlers = self.message_handler_map.get(msgType, {})
+        pattern = is_topic_pattern(msgType)
+        removed = 0
+        for receiver in receivers:
+            if receiver in registered:
+                registered.remove(receiver)
+                handlers.pop(receiver, None)
+                if pattern:
+                    self.topic_trie.remove(msgType, receiver)
+                removed += 1
+        if removed:
+            self._invalidate_dispatch(msgType)
+        return removed
     def register_receiver(self, receiver):
         for s in receiver.subscriptions:
             self.add_receiver(receiver, s)
     def unregister_receiver(self, receiver):
         for s in receiver.subscriptions:
             self.remove_receiver(receiver, s)
-    def get_message_count(self):
-        return len(self.active_queue)
+    def register_receivers(self, receivers):
+        '''registers many receivers at once, each message type they subscribe to is updated once'''
+        for msgType, subscribers in self._group_subscriptions(receivers).iteritems():
+            self.add_receivers(subscribers, msgType)
+    def unregister_receivers(self, receivers):
+        '''un-registers many receivers at once, each message type they subscribe to is updated once'''
+        for msgType, subscribers in self._group_subscriptions(receivers).iteritems():
+            self.remove_receivers(subscribers, msgType)
+    def _group_subscriptions(self, receivers):
+        '''returns {message type: [receiver]} of the receivers' subscriptions'''
+        grouped = {}
+        for receiver in receivers:
+            for msgType in receiver.subscriptions:
+                grouped.setdefault(msgType, []).append(receiver)
+        return grouped
+    def get_message_count(self, priority=None):
+        '''returns the number of queued messages, of all lanes or only the lane of the given priority'''
+        if priority is None:
+            return sum(len(q) for q in self.active_queues.itervalues())
+        return len(self.active_queues.get(priority, ()))
     def reset(self):
         '''removes all messages, receivers, used for debugging/testing'''
-        self.message_types = []
-        self.message_receiver_map = {WildCardMessageType: []}
-        self.active_queue = collections.deque()
-        self.processing_queue = collections.deque()
+        self.message_types = set()
+        self.message_receiver_map = {WildCardMessageType: set()}
+        self.message_handler_map = {}
+        self._dispatch_table = {}
+        self._wildcard_dispatch_table = {}
+        self.topic_trie = TopicTrie()
+        self._pattern_table = {}
+        self._reset_queues()
+        self._reset_scheduler()
+        self._reset_queue_limits()
+        self.ingress_event = None
+        self.interest_grid = None
+        self._spatial_tables = {}
+        self.metrics = None
+        self.disable_profiling()
+        self.shutdown_offload_pools(wait=False)
     def reset_to_client_mode(self):
-        self.active_queue = collections.deque()
-        self.processing_queue = collections.deque()
-        self.message_receiver_map = dict( (x,[]) for x in self.message_receiver_map.keys() )
+        self._reset_queues()
+        self._reset_scheduler()
+        self._reset_queue_limits()
+        self.message_receiver_map = dict( (x,set()) for x in self.message_receiver_map.keys() )
+        self.message_handler_map = {}
+        self._dispatch_table = {}
+        self._wildcard_dispatch_table = {}
+        self.topic_trie = TopicTrie()
+        self._pattern_table = {}
+        self.interest_grid = None
+        self._spatial_tables = {}
+        # pool threads do not survive the fork
+        self.offload_pools = {}
+        self._offload_states = {}
           
\ No newline at end of file
@@ -0,0 +1,89 @@
+# spatial.py
+# area of interest bookkeeping for messages that carry a location
+import math
+
+class InterestGrid(object):
+    '''
+    uniform grid of circular interest regions in the plane
+
+    each region is linked to every cell its bounding box overlaps, so a point is looked up in a single cell.
+    moving a region within the same cells only updates its coordinates.
+    '''
+    def __init__(self, cell_size=100.0):
+        self.cell_size = float(cell_size)
+        # (column, row) -> set of receivers whose region overlaps the cell
+        self.cells = {}
+        # receiver -> [x, y, radius, (first column, first row, last column, last row)]
+        self.regions = {}
+    def __contains__(self, receiver):
+        return receiver in self.regions
+    def __len__(self):
+        return len(self.regions)
+    def _cell_range(self, x, y, radius):
+        size = self.cell_size
+        return (int(math.floor((x - radius) / size)), int(math.floor((y - radius) / size)),
+                int(math.floor((x + radius) / size)), int(math.floor((y + radius) / size)))
+    def set(self, receiver, position, radius=None):
+        '''
+        sets the interest region of the receiver, ``radius`` defaults to the receiver's current one
+
+        :Return:
+            - true: if the receiver was not in the grid before
+            - false: otherwise
+        '''
+        region = self.regions.get(receiver)
+        if radius is None:
+            if region is None:
+                raise ValueError('%s has no interest region yet, a radius is required' % receiver)
+            radius = region[2]
+        x, y = position[0], position[1]
+        cells = self._cell_range(x, y, radius)
+        if region is not None:
+            region[0], region[1], region[2] = x, y, radius
+            if region[3] != cells:
+                self._unlink(receiver, region[3])
+                self._link(receiver, cells)
+                region[3] = cells
+            return False
+        self._link(receiver, cells)
+        self.regions[receiver] = [x, y, radius, cells]
+        return True
+    def remove(self, receiver):
+        '''removes the receiver's region, returns false if it had none'''
+        region = self.regions.pop(receiver, None)
+        if region is None:
+            return False
+        self._unlink(receiver, region[3])
+        return True
+    def query(self, position):
+        '''returns the receivers whose region contains the position'''
+        x, y = position[0], position[1]
+        size = self.cell_size
+        cell = self.cells.get((int(math.floor(x / size)), int(math.floor(y / size))))
+        if not cell:
+            return []
+        regions = self.regions
+        found = []
+        for receiver in cell:
+            rx, ry, radius = regions[receiver][:3]
+            if (rx - x) * (rx - x) + (ry - y) * (ry - y) <= radius * radius:
+                found.append(receiver)
+        return found
+    def _link(self, receiver, cell_range):
+        x0, y0, x1, y1 = cell_range
+        cells = self.cells
+        for column in xrange(x0, x1 + 1):
+            for row in xrange(y0, y1 + 1):
+                cell = cells.get((column, row))
+                if cell is None:
+                    cell = cells[(column, row)] = set()
+                cell.add(receiver)
+    def _unlink(self, receiver, cell_range):
+        x0, y0, x1, y1 = cell_range
+        cells = self.cells
+        for column in xrange(x0, x1 + 1):
+            for row in xrange(y0, y1 + 1):
+                cell = cells[(column, row)]
+                cell.discard(receiver)
+                if not cell:
+                    del cells[(column, row)]
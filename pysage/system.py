@@ -27,14 +27,51 @@
 import struct
 import messaging
 import transport
+import spatial
 import util
 import time
 import process as processing
 import logging
 import warnings
+import re
+import collections
+import bisect
+import os
+import sys
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+ASYNCIO_AVAILABLE = asyncio is not None
 
 __all__ = ('Message', 'ActorManager', 'Actor', 'PacketError', 'PacketTypeError', 'GroupAlreadyExists', 'GroupDoesNotExist', 'CreateGroupError',
-           'DefaultActorFailed', 'GroupFailed', 'get_logger', 'WrongMessageTypeSpecified')
+           'DefaultActorFailed', 'GroupFailed', 'get_logger', 'WrongMessageTypeSpecified', 'CompactMessage',
+           'InterestNotSet', 'POOL_ROUND_ROBIN', 'POOL_LEAST_BACKLOG', 'POOL_KEY_HASH')
+
+# how a process pool picks the worker of a message, see ActorManager.add_process_pool
+POOL_ROUND_ROBIN = 'round_robin'
+POOL_LEAST_BACKLOG = 'least_backlog'
+POOL_KEY_HASH = 'key_hash'
+
+# internal packet of a pool worker reporting its backlog to the main group: packet id, messages received, messages queued
+_BACKLOG_PACKET = 1
+_BACKLOG_FORMAT = '!BQQ'
+# internal packet waking a child group up so that it sees its quit switch
+_WAKE_PACKET = 2
+# optional trailer of a packed message with a deadline: marker byte, then the seconds left
+_DEADLINE_MARKER = '\x01'
+_DEADLINE_FORMAT = '!d'
+_DEADLINE_SIZE = 1 + struct.calcsize(_DEADLINE_FORMAT)
+
+# selector data of the network transport sockets and of the wakeup pipe, IPC peers are registered with their id
+_NETWORK_SOCKET = object()
+_WAKEUP_PIPE = object()
+# select only takes sockets on windows, not the pipes used for IPC
+_CAN_SELECT_PIPES = sys.platform != 'win32'
 
 GROUP_WARNING_MESSAGE = '''Please call mgr.enable_groups() first before using "groups" mode.  This ensures that your app is safe when "frozen" into an executable in Windows.  Also ensure any "add_process_group" calls happen under the main function (i.e.: if __name__ == '__main__' ...).  This is required under Windows.  See "Grouping" documentation.'''
 
@@ -70,10 +107,20 @@ class ConcreteMessageAlreadyDefined(Exception):
 class GroupsNotEnabled(Exception):
     pass
 
+class EventLoopError(Exception):
+    pass
+
+class InterestNotSet(Exception):
+    pass
+
 def get_logger():
     return processing.get_logger()
+
+def _set_nonblocking(fd):
+    import fcntl
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
     
-def _subprocess_main(name, default_actor_class, max_tick_time, interval, server_addr, _should_quit, packet_types):
+def _subprocess_main(name, default_actor_class, max_tick_time, interval, server_addr, _should_quit, packet_types, report_backlog=False):
     '''interval is in milliseconds of how long to sleep before another tick'''
     # creating a client mode manager
     # after forking, we would already have an instance tied to the parent PID, simply change that to our PID
@@ -105,10 +152,13 @@ def _subprocess_main(name, default_actor_class, max_tick_time, interval, server_
         except Exception, e:
             manager.log(logging.ERROR, 'process "%s" failed with: %s' % (processing.get_pid(processing.current_process()), e))
             raise
-        # we want to sleep the difference between the time it took to process and the interval desired
-        _time_to_sleep = interval - (util.get_time() - start)
-        if _time_to_sleep > 0.0:
-            time.sleep(_time_to_sleep)
+        if report_backlog:
+            manager._report_backlog()
+        # wait for the next packet or timer, actors to update want a tick every interval
+        timeout = None
+        if manager._has_updates() or not manager._can_wait_for_packets():
+            timeout = max(0.0, interval - (util.get_time() - start))
+        manager.wait(timeout)
     return False
 
 class ActorManager(messaging.MessageManager):
@@ -118,6 +168,8 @@ class ActorManager(messaging.MessageManager):
         messaging.MessageManager.init(self)
         self.objectIDMap = {}
         self.objectNameMap = {}
+        # gid -> name, so that unregistering does not search objectNameMap
+        self.actorNames = {}
         
         self.gid = 0
         self.transport = None
@@ -129,6 +181,45 @@ class ActorManager(messaging.MessageManager):
         self.is_main_process = True
         self._groups_enabled = False
         self.ipc_transport = transport.IPCTransport()
+        # process pools: name -> _ProcessPool, and worker ipc client id -> (pool, worker group name)
+        self.pools = {}
+        self._pool_clients = {}
+        # messages received from the main group and the last backlog reported to it, see add_process_pool
+        self._ipc_received = 0
+        self._last_backlog_report = None
+        # asyncio integration, see attach_event_loop
+        self.event_loop = None
+        # pipe waking "wait" up when a message is posted from another thread
+        self._wakeup_pipe = None
+        # the IPC peers, network sockets and wakeup pipe waited on, see "wait"
+        self._selector = None
+        self._network_selectable = False
+        self._loop_interval = None
+        self._loop_max_tick_time = None
+        self._loop_handle = None
+        self._loop_handle_due = None
+        self._loop_readers = set()
+        # per sender backlogs of network messages, see enable_fair_queuing
+        self.fair_input = None
+        self._reset_updates()
+    def _reset_updates(self):
+        # awake actors updated every tick: _SYNC_PRIORITY -> {gid: actor}, visited from the highest priority down
+        self._update_buckets = {}
+        self._update_priorities = []
+        # awake actors with an "update_every" or "update_interval": gid -> (actor, token)
+        self._scheduled_updates = {}
+        # update count -> [(actor, token)] of "update_every" actors
+        self._tick_schedule = {}
+        # gid -> timer of "update_interval" actors, and the actors whose interval came due: priority -> [actor]
+        self._update_timers = {}
+        self._due_updates = {}
+        # sleeping actors, woken up by the next message delivered to them
+        self._sleeping = {}
+        # message type -> (dispatch table, {subscriber: index in it}), see _rewire_handlers
+        self._dispatch_positions = {}
+        self.update_count = 0
+        # actor -> set of its _ActorTimer, see schedule_every
+        self._actor_timers = {}
     def find(self, name):
         '''returns an actor by its name, None if not found'''
         return self.get_actor_by_name(name)
@@ -155,19 +246,32 @@ class ActorManager(messaging.MessageManager):
                 raise ConcreteMessageAlreadyDefined('A concrete message class of the name "%s" is already defined.  Adhoc messages of this type are not allowed.' % msg)
             msg = Message(message_type = msg)
         obj = self.objectIDMap[id]
-        for recr in self.message_receiver_map[messaging.WildCardMessageType]:
-            recr.handle_message(msg)
-        return obj.handle_message(msg)
-    def queue_message_to_actor(self, id, msg):
+        msg.receiverID = id
+        for recr, handler in self._get_wildcard_dispatch(msg.message_type):
+            handler(msg)
+        # the dispatch table handler wakes a sleeping actor and runs batch and offloaded handlers
+        handler = self.get_designated_handler(msg)
+        if handler is None:
+            res = obj.handle_message(msg)
+        else:
+            res = handler(msg)
+        if self._pending_batches and not self._dispatching:
+            self._flush_batches()
+        return res
+    def queue_message_to_actor(self, id, msg, priority=None, delay=None, deliver_at=None, ttl=None):
         '''
         queues message designated for a specific actor
 
         :Parameters:
             - `id`: the "id" of the actor
             - `msg`: the message to be queued
+            - `priority`: optional.  overrides the priority lane of the message
+            - `delay`: optional.  seconds to hold the message before queuing it
+            - `deliver_at`: optional.  time (in ``util.get_time`` seconds) to hold the message until
+            - `ttl`: optional.  seconds within which the message must be dispatched
         '''
         msg.receiverID = id
-        self.queue_message(msg)
+        self.queue_message(msg, priority, delay, deliver_at, ttl)
         return True
     def register_actor(self, obj, name=None):
         '''
@@ -178,10 +282,48 @@ class ActorManager(messaging.MessageManager):
             - `name`: optional.  The name of the actor for which you can refer back to the actor later
         '''
         messaging.MessageManager.register_receiver(self, obj)
-        self.objectIDMap[obj.gid] = obj
+        self._add_actor(obj, name)
+        return obj
+    def register_actors(self, objs, names=None):
+        '''
+        registers many actors at once, the subscriptions of each message type are updated once for all of them
+        
+        :Parameters:
+            - `objs`: the actors to be registered
+            - `names`: optional.  a name for each actor, in the same order, None for actors without one
+        '''
+        objs = list(objs)
+        self.register_receivers(objs)
+        for obj, name in map(None, objs, names or ()):
+            self._add_actor(obj, name)
+        return objs
+    def register_actor_array(self, array, name=None):
+        '''
+        registers an ActorArray: the array is updated once per tick with "update_batch", 
+        its members are registered as actors and receive messages on their own
+        '''
+        self.register_actor(array, name)
+        array.manager = self
+        self.register_actors(array.entries)
+        return array
+    def unregister_actor_array(self, array):
+        '''unregisters an ActorArray and all of its members'''
+        self.unregister_actors(array.entries)
+        array.manager = None
+        return self.unregister_actor(array)
+    def _add_actor(self, obj, name):
+        gid = obj.gid
+        self.objectIDMap[gid] = obj
         if name:
             self.objectNameMap[name] = obj
-        return obj
+            self.actorNames[gid] = name
+        self._schedule_updates(obj)
+        # timers scheduled before the actor was registered, in its constructor for instance, start now
+        pending = getattr(obj, '_pending_timers', None)
+        if pending:
+            obj._pending_timers = None
+            for timer in pending:
+                self._start_actor_timer(timer)
     def unregister_actor(self, obj):
         '''
         unregister the actor from the actor manager.  actor will no longer receive messages or have its "update" method called
@@ -190,18 +332,266 @@ class ActorManager(messaging.MessageManager):
             - `obj`: the actor being unregistered
         '''
         messaging.MessageManager.unregister_receiver(self, obj)
-        del self.objectIDMap[obj.gid]
-        
-        # deleting the actor from the dictionary the safe way
-        n = None
-        for name,o in self.objectNameMap.items():
-            if o == obj:
-                n = name
-                break
-        if not n == None:
-            del self.objectNameMap[n]
-                
+        self._remove_actor(obj)
         return self
+    def unregister_actors(self, objs):
+        '''unregisters many actors at once, the subscriptions of each message type are updated once for all of them'''
+        objs = list(objs)
+        self.unregister_receivers(objs)
+        for obj in objs:
+            self._remove_actor(obj)
+        return self
+    def _remove_actor(self, obj):
+        gid = obj.gid
+        del self.objectIDMap[gid]
+        # the name may have been given to another actor since
+        name = self.actorNames.pop(gid, None)
+        if name is not None and self.objectNameMap.get(name) is obj:
+            del self.objectNameMap[name]
+        self._unschedule_updates(obj)
+        self._sleeping.pop(obj, None)
+        for timer in self._actor_timers.pop(obj, ()):
+            self.cancel_timer(timer.entry)
+        if self.interest_grid is not None:
+            self.clear_interest(obj)
+    def schedule_every(self, obj, interval, callback, *args):
+        '''
+        calls ``callback(*args)`` every ``interval`` seconds, on the first tick each call comes due.  
+        the timer is cancelled when the actor is unregistered.  the timer of an actor that is not registered
+        yet starts when the actor is registered
+        
+        :Parameters:
+            - `obj`: the actor that owns the timer
+            - `interval`: seconds between calls
+            - `callback`: the callable
+        
+        :Return: the timer, to be given to "cancel_actor_timer"
+        '''
+        return self._add_actor_timer(_ActorTimer(obj, interval, callback, args, True))
+    def schedule_once(self, obj, delay, callback, *args):
+        '''same as schedule_every, but calls ``callback(*args)`` only once, after ``delay`` seconds'''
+        return self._add_actor_timer(_ActorTimer(obj, delay, callback, args, False))
+    def cancel_actor_timer(self, timer):
+        '''cancels a timer returned by schedule_every or schedule_once, returns false if it was done already'''
+        if timer.entry is None:
+            pending = getattr(timer.actor, '_pending_timers', None)
+            if not pending or timer not in pending:
+                return False
+            pending.remove(timer)
+            return True
+        timers = self._actor_timers.get(timer.actor)
+        if not timers or timer not in timers:
+            return False
+        timers.remove(timer)
+        if not timers:
+            del self._actor_timers[timer.actor]
+        self.cancel_timer(timer.entry)
+        return True
+    def _add_actor_timer(self, timer):
+        if timer.actor.gid not in self.objectIDMap:
+            # kept by the actor rather than the manager, so an actor that is never registered leaves nothing behind
+            pending = getattr(timer.actor, '_pending_timers', None)
+            if pending is None:
+                pending = timer.actor._pending_timers = []
+            pending.append(timer)
+            return timer
+        self._start_actor_timer(timer)
+        return timer
+    def _start_actor_timer(self, timer):
+        timer.entry = self.call_at(util.get_time() + timer.interval, self._fire_actor_timer, timer)
+        self._actor_timers.setdefault(timer.actor, set()).add(timer)
+    def _fire_actor_timer(self, timer):
+        if timer.repeat:
+            # keep the period, unless the ticks fell a whole interval behind
+            due = max(timer.entry[0] + timer.interval, util.get_time())
+            timer.entry = self.call_at(due, self._fire_actor_timer, timer)
+        else:
+            self.cancel_actor_timer(timer)
+        timer.callback(*timer.args)
+    def enable_interest_management(self, cell_size=100.0):
+        '''
+        starts filtering messages with a "location" by the interest regions of their subscribers
+        
+        :Parameters:
+            - `cell_size`: side of the grid cells, about the typical interest radius works well
+        '''
+        old = self.interest_grid
+        if old is not None and old.cell_size == float(cell_size):
+            return old
+        self.interest_grid = spatial.InterestGrid(cell_size)
+        if old is not None:
+            for obj, region in old.regions.iteritems():
+                self.interest_grid.set(obj, region[:2], region[2])
+        self._spatial_tables = {}
+        return self.interest_grid
+    def set_interest(self, obj, position, radius):
+        '''
+        sets the actor's area of interest.  broadcast messages with a "location" outside of it are not delivered to it, 
+        actors without an area of interest receive them all
+        
+        :Parameters:
+            - `obj`: the registered actor
+            - `position`: (x, y) center of the area
+            - `radius`: radius of the area
+        '''
+        if self.interest_grid is None:
+            self.enable_interest_management()
+        if self.interest_grid.set(obj, position, radius):
+            self._spatial_tables = {}
+    def move_actor(self, obj, position):
+        '''moves the actor's area of interest, cheap enough to be called on every tick'''
+        if self.interest_grid is None or obj not in self.interest_grid:
+            raise InterestNotSet('Actor %s has no area of interest to move, call "set_interest" first' % obj)
+        self.interest_grid.set(obj, position)
+    def clear_interest(self, obj):
+        '''removes the actor's area of interest, it receives all messages again.  does nothing if it had none'''
+        if self.interest_grid is not None and self.interest_grid.remove(obj):
+            self._spatial_tables = {}
+    def _schedule_updates(self, obj):
+        '''adds the actor to the update buckets, or schedules its next update if it declares a frequency'''
+        # actors that do not override "update" are never visited
+        if getattr(type(obj).update, '__func__', None) is messaging.MessageReceiver.update.__func__:
+            return
+        priority = getattr(obj, '_SYNC_PRIORITY', 0)
+        if priority not in self._update_buckets:
+            self._update_buckets[priority] = {}
+            self._update_priorities = sorted(self._update_buckets, reverse=True)
+        interval = getattr(obj, 'update_interval', None)
+        every = getattr(obj, 'update_every', 1) or 1
+        if not interval and every == 1:
+            self._update_buckets[priority][obj.gid] = obj
+            return
+        # a new token for each schedule, so entries left from before a sleep are recognized as stale
+        token = object()
+        self._scheduled_updates[obj.gid] = (obj, token)
+        if interval:
+            self._update_timers[obj.gid] = self.call_at(util.get_time() + interval, self._interval_update, obj, token)
+        else:
+            self._tick_schedule.setdefault(self.update_count + every, []).append((obj, token))
+    def _unschedule_updates(self, obj):
+        gid = obj.gid
+        for bucket in self._update_buckets.itervalues():
+            bucket.pop(gid, None)
+        self._scheduled_updates.pop(gid, None)
+        timer = self._update_timers.pop(gid, None)
+        if timer is not None:
+            self.cancel_timer(timer)
+    def _interval_update(self, obj, token):
+        entry = self._scheduled_updates.get(obj.gid)
+        if entry is None or entry[1] is not token:
+            return
+        self._due_updates.setdefault(getattr(obj, '_SYNC_PRIORITY', 0), []).append(obj)
+        self._update_timers[obj.gid] = self.call_at(util.get_time() + obj.update_interval, self._interval_update, obj, token)
+    def _has_updates(self):
+        '''returns true if some actors are updated every tick or every few ticks'''
+        return bool(self._tick_schedule) or any(self._update_buckets.itervalues())
+    def _collect_updates(self):
+        '''returns the actors to be updated on this tick, in _SYNC_PRIORITY order'''
+        self.update_count += 1
+        due = self._due_updates
+        self._due_updates = {}
+        if self._tick_schedule:
+            for obj, token in self._tick_schedule.pop(self.update_count, ()):
+                entry = self._scheduled_updates.get(obj.gid)
+                if entry is not None and entry[1] is token:
+                    due.setdefault(getattr(obj, '_SYNC_PRIORITY', 0), []).append(obj)
+                    self._tick_schedule.setdefault(self.update_count + obj.update_every, []).append((obj, token))
+        actors = []
+        for priority in self._update_priorities:
+            actors.extend(self._update_buckets[priority].itervalues())
+            if due and priority in due:
+                actors.extend(due[priority])
+        return actors
+    def sleep_actor(self, obj):
+        '''
+        stops updating the actor until a message is delivered to it.  
+        the actor is woken up just before the message is handled
+        
+        :Parameters:
+            - `obj`: the registered actor to put to sleep
+        '''
+        if obj.gid not in self.objectIDMap or obj in self._sleeping:
+            return False
+        self._unschedule_updates(obj)
+        self._sleeping[obj] = True
+        self._rewire_handlers(obj)
+        return True
+    def wake_actor(self, obj):
+        '''resumes updating a sleeping actor'''
+        if self._sleeping.pop(obj, None) is None:
+            return False
+        self._schedule_updates(obj)
+        self._rewire_handlers(obj)
+        return True
+    def _rewire_handlers(self, obj):
+        '''
+        adds or removes the waking layer of the actor's handlers after it went to sleep or woke up.
+        only its own entries of the cached dispatch tables are replaced, and the handlers themselves are kept,
+        so that a batch being collected is not split
+        '''
+        for msgType in obj.subscriptions:
+            if msgType == messaging.WildCardMessageType:
+                # wild card handlers are resolved per message type, they only live in the wild card tables
+                for table in self._wildcard_dispatch_table.itervalues():
+                    self._rewire_entries(obj, table)
+                continue
+            handlers = self.message_handler_map.get(msgType)
+            if handlers is None or obj not in handlers:
+                continue
+            handlers[obj] = self._rewired(obj, handlers[obj])
+            if messaging.is_topic_pattern(msgType):
+                for pattern_handlers in self._pattern_table.itervalues():
+                    if obj in pattern_handlers:
+                        pattern_handlers[obj] = self._rewired(obj, pattern_handlers[obj])
+                # the tables of the matching message types are built again from the patched handlers
+                self._dispatch_table.clear()
+                continue
+            table = self._dispatch_table.get(msgType)
+            if table is None:
+                continue
+            positions = self._dispatch_positions.get(msgType)
+            if positions is None or positions[0] is not table:
+                positions = self._cache_dispatch(self._dispatch_positions, msgType, (table, dict((r, i) for i, (r, h) in enumerate(table))))
+            i = positions[1].get(obj)
+            if i is None:
+                continue
+            # the table is patched in place so that its spatial split stays valid
+            entry = table[i] = (obj, self._rewired(obj, table[i][1]))
+            split = self._spatial_tables.get(msgType)
+            if split is not None and split[0] is table:
+                split[1][obj] = entry[1]
+                if obj not in self.interest_grid:
+                    self._rewire_entries(obj, split[2])
+    def _rewire_entries(self, obj, table):
+        for i, (r, handler) in enumerate(table):
+            if r is obj:
+                table[i] = (r, self._rewired(obj, handler))
+    def _rewired(self, obj, handler):
+        '''returns the handler with a waking layer if the actor sleeps, without one otherwise'''
+        if isinstance(handler, messaging._ProfiledHandler):
+            return handler.profiler.wrap(obj, handler.message_type, self._rewired(obj, handler.handler))
+        if isinstance(handler, _WakingHandler):
+            handler = handler.handler
+        if obj in self._sleeping:
+            return _WakingHandler(self, obj, handler)
+        return handler
+    def _wrap_handler(self, receiver, handler):
+        '''handlers of sleeping actors wake them up first'''
+        handler = messaging.MessageManager._wrap_handler(self, receiver, handler)
+        if receiver in self._sleeping:
+            return _WakingHandler(self, receiver, handler)
+        return handler
+    def get_designated_handler(self, msg):
+        '''looks up the designated actor by its gid, instead of walking all subscribers of the message type'''
+        obj = self.objectIDMap.get(msg.receiverID)
+        if obj is None:
+            return None
+        handler = self.message_handler_map.get(msg.message_type, {}).get(obj)
+        if handler is None and self.topic_trie:
+            handler = self._get_pattern_handlers(msg.message_type).get(obj)
+        if handler and self.profiler is not None:
+            return self.profiler.wrap(obj, msg.message_type, handler)
+        return handler
     def designated_to_handle(self, r, m):
         '''handles designated messages'''
         if m.receiverID:
@@ -232,26 +622,51 @@ class ActorManager(messaging.MessageManager):
         cut_off_time = None
         if max_time:
             cut_off_time = util.get_time() + max_time
+        metrics = self.metrics
+        if metrics is not None:
+            phase_start = util.get_time()
         # server manager need to monitor sub-groups
         if self.is_main_process:
             for group, (p, _id, switch) in self.groups.items():    
                 if not processing.is_alive(p):
                     raise GroupFailed('Group "%s" failed' % group, group)
 
-        # always poll at least one ipc message here
-        has_more = True
-        while has_more:
-            has_more = self.ipc_transport.poll(self.packet_handler)
-            if cut_off_time and util.get_time() > cut_off_time:
-                break
+        # always poll at least one ipc message here, unless the queue is over its high water mark
+        if _CAN_SELECT_PIPES:
+            # a single poll call tells which peers and sockets have packets
+            ready = self._select_ready(0)
+            ids = [data for data in ready if data is not _NETWORK_SOCKET and data is not _WAKEUP_PIPE]
+            while ids and not self.is_over_high_water_mark():
+                ids = self.ipc_transport.poll_peers(self.ipc_packet_handler, ids)
+                if cut_off_time and util.get_time() > cut_off_time:
+                    break
+        else:
+            has_more = True
+            while has_more and not self.is_over_high_water_mark():
+                has_more = self.ipc_transport.poll(self.ipc_packet_handler)
+                if cut_off_time and util.get_time() > cut_off_time:
+                    break
+        if metrics is not None:
+            phase_start = metrics.add_phase('ipc_poll', phase_start)
         
-        # always poll at least one network message here
-        if self.transport:
+        # always poll at least one network message here, transports without sockets are always polled
+        if self.transport and (not _CAN_SELECT_PIPES or not self._network_selectable or _NETWORK_SOCKET in ready):
+            if self.fair_input is None:
+                packet_handler = self.packet_handler
+            else:
+                packet_handler = self.fair_packet_handler
             has_more = True
-            while has_more:
-                has_more = self.transport.poll(self.packet_handler)
+            while has_more and not self.is_over_high_water_mark():
+                has_more = self.transport.poll(packet_handler)
                 if cut_off_time and util.get_time() > cut_off_time:
                     break
+            for address in self.transport.pop_disconnected():
+                if self.fair_input is not None:
+                    self.fair_input.forget(address)
+        if self.fair_input is not None:
+            self._release_fair_input()
+        if metrics is not None:
+            metrics.add_phase('network_poll', phase_start)
 
 #        self.log(logging.DEBUG, 'process "%s" queue length: %s' % (processing.get_pid(processing.current_process()), self.queue_length))
         
@@ -261,9 +676,201 @@ class ActorManager(messaging.MessageManager):
             new_max_time = cut_off_time - util.get_time()
         # process these messages given the newly calculated max time
         ret = messaging.MessageManager.tick(self, max_time = new_max_time, **kws)
-        # then update all actors
-        map(lambda x: x.update(*args, **kws), sorted(self.objectIDMap.values(), lambda x,y: y._SYNC_PRIORITY - x._SYNC_PRIORITY))
+        if metrics is not None:
+            phase_start = util.get_time()
+        # then update the actors that are awake and due
+        actors = self._collect_updates()
+        if self.profiler is None:
+            for x in actors:
+                x.update(*args, **kws)
+        else:
+            for x in actors:
+                self.profiler.call(x, 'update', x.update, *args, **kws)
+        if metrics is not None:
+            metrics.add_phase('actor_update', phase_start)
         return ret
+    def attach_event_loop(self, loop=None, interval=None, max_tick_time=None):
+        '''
+        runs the manager inside an asyncio event loop instead of a "tick" and "sleep" loop
+        
+        the IPC and network transports register their sockets with the loop and the manager ticks as soon as
+        any of them is readable, a message is queued or a timer is due.  Handlers may return awaitables 
+        (i.e.: be "async def" functions), those are scheduled on the loop.
+        
+        :Parameters:
+            - `loop`: optional.  the event loop to attach to, defaults to the current event loop
+            - `interval`: optional.  also tick at least every "interval" seconds, needed if actors rely on "update"
+            - `max_tick_time`: optional.  passed to each "tick" as "max_time"
+        '''
+        if not ASYNCIO_AVAILABLE:
+            raise EventLoopError('asyncio (or trollius) is required to attach the manager to an event loop')
+        if self.event_loop is not None:
+            raise EventLoopError('manager is already attached to an event loop')
+        self.event_loop = loop or asyncio.get_event_loop()
+        self._loop_interval = interval
+        self._loop_max_tick_time = max_tick_time
+        self._wakeup = self._wakeup_event_loop
+        self._ingress_wakeup = self._wakeup_event_loop_threadsafe
+        self._sync_event_loop_readers()
+        self._schedule_loop_tick(0)
+        return self
+    def detach_event_loop(self):
+        '''stops ticking from the event loop and unregisters the transports from it'''
+        if self.event_loop is None:
+            return self
+        for fd in self._loop_readers:
+            self.event_loop.remove_reader(fd)
+        self._loop_readers = set()
+        if self._loop_handle:
+            self._loop_handle.cancel()
+        self._loop_handle = self._loop_handle_due = None
+        self._wakeup = self._ingress_wakeup = None
+        self.event_loop = None
+        return self
+    def _watched_filenos(self):
+        '''file descriptors of the IPC and network transports that signal incoming packets'''
+        fds = self.ipc_transport.filenos()
+        if self.transport:
+            fds = fds + self.transport.filenos()
+        return set(fds)
+    def _can_wait_for_packets(self):
+        '''returns false if packets may arrive without any watched file descriptor becoming readable'''
+        if sys.platform == 'win32':
+            # select only takes sockets there, not pipes
+            return False
+        # the bare Transport that "reset" leaves in place never has packets
+        t = self.transport
+        return not t or type(t) is transport.Transport or bool(t.filenos())
+    def wait(self, timeout=None):
+        '''
+        blocks until a packet arrives from a group or the network, a message is posted from another thread or 
+        a timer is due, so that the main loop does not need to sleep between ticks::
+        
+            while True:
+                mgr.wait(.03)       # at most 30 milliseconds, actors rely on "update"
+                mgr.tick()
+        
+        the IPC connections and the sockets of the transport are waited on with a single "poll" call.  
+        transports without sockets (i.e.: MongoDBTransport) and IPC pipes on windows cannot be waited on, 
+        the call then sleeps ``timeout`` seconds (30 milliseconds if None).
+        
+        :Parameters:
+            - `timeout`: optional.  seconds to wait at most, None to wait until something happens
+        
+        :Return:
+            - true: if there is something to process
+            - false: if the timeout passed
+        '''
+        if self.event_loop is not None:
+            raise EventLoopError('The manager is attached to an event loop, the loop waits for packets')
+        due = False
+        delay = self.next_tick_delay()
+        if delay is not None and (timeout is None or delay <= timeout):
+            timeout, due = delay, True
+        if timeout == 0:
+            return due
+        if not self._can_wait_for_packets():
+            time.sleep(timeout if timeout is not None else .03)
+            return True
+        if self._wakeup_pipe is None:
+            self._wakeup_pipe = os.pipe()
+            for fd in self._wakeup_pipe:
+                _set_nonblocking(fd)
+        self._ingress_wakeup = self._write_wakeup_pipe
+        # posted before posting wrote to the pipe
+        if self._ingress:
+            return True
+        return bool(self._select_ready(timeout)) or due
+    def _select_ready(self, timeout):
+        '''returns the selector data of the IPC peers, network sockets and wakeup pipe that are readable'''
+        selector = self._selector
+        if selector is None:
+            selector = self._selector = transport.Selector()
+        fds = self.ipc_transport.peer_filenos()
+        network = self.transport and self.transport.filenos() or ()
+        for fd in network:
+            fds[fd] = _NETWORK_SOCKET
+        self._network_selectable = bool(network)
+        if self._wakeup_pipe is not None:
+            fds[self._wakeup_pipe[0]] = _WAKEUP_PIPE
+        selector.update(fds)
+        ready = selector.select(timeout)
+        if _WAKEUP_PIPE in ready:
+            try:
+                while os.read(self._wakeup_pipe[0], 4096):
+                    pass
+            except OSError:
+                pass
+        return ready
+    def _write_wakeup_pipe(self):
+        try:
+            os.write(self._wakeup_pipe[1], '\0')
+        except OSError:
+            # full, the waiting loop is woken up anyway
+            pass
+    def _transports_changed(self):
+        '''called whenever a group, a peer or a transport was added or removed'''
+        if self.event_loop is not None:
+            self._sync_event_loop_readers()
+    def _sync_event_loop_readers(self):
+        # stop watching while the queue is over its high water mark, the pending messages keep the loop ticking
+        if self.is_over_high_water_mark():
+            fds = set()
+        else:
+            fds = self._watched_filenos()
+        for fd in self._loop_readers - fds:
+            self.event_loop.remove_reader(fd)
+        for fd in fds - self._loop_readers:
+            self.event_loop.add_reader(fd, self._wakeup_event_loop)
+        self._loop_readers = fds
+    def _wakeup_event_loop(self):
+        self._schedule_loop_tick(0)
+    def _wakeup_event_loop_threadsafe(self):
+        self.event_loop.call_soon_threadsafe(self._wakeup_event_loop)
+    def _schedule_loop_tick(self, delay):
+        '''makes sure the loop ticks within "delay" seconds, an earlier scheduled tick is kept'''
+        due = self.event_loop.time() + delay
+        if self._loop_handle is not None:
+            if self._loop_handle_due <= due:
+                return
+            self._loop_handle.cancel()
+        if delay:
+            self._loop_handle = self.event_loop.call_later(delay, self._loop_tick)
+        else:
+            self._loop_handle = self.event_loop.call_soon(self._loop_tick)
+        self._loop_handle_due = due
+    def _loop_tick(self):
+        self._loop_handle = self._loop_handle_due = None
+        try:
+            self.tick(max_time=self._loop_max_tick_time)
+        finally:
+            if self.event_loop is not None:
+                # accepted and closed peers change the sockets to watch
+                self._sync_event_loop_readers()
+                delay = self.next_tick_delay()
+                if self._loop_interval is not None and (delay is None or delay > self._loop_interval):
+                    delay = self._loop_interval
+                if delay is not None:
+                    self._schedule_loop_tick(delay)
+    def _start_awaitable(self, handler, res):
+        '''
+        futures and the coroutines of event loop coroutine handlers are driven by the attached event loop
+        
+        trollius coroutines are plain generators like pysage coroutines, they are told apart by their handler: 
+        it is decorated with "asyncio.coroutine" (or is an "async def" function)
+        '''
+        if self.event_loop is None:
+            return False
+        if not isinstance(res, asyncio.Future):
+            if not asyncio.iscoroutine(res):
+                return False
+            # look through the dispatch table wrappers (sleeping actors, batches, offloading)
+            while not asyncio.iscoroutinefunction(handler):
+                handler = getattr(handler, 'handler', None)
+                if handler is None:
+                    return False
+        asyncio.ensure_future(res, loop=self.event_loop)
+        return True
     def log(self, level, msg):
         '''process aware logging'''
         return processing.get_logger().log(level, msg)
@@ -288,6 +895,7 @@ class ActorManager(messaging.MessageManager):
             self.log(logging.DEBUG, 'connected to client: %s' % client_address)
         self.transport = transport_class()
         self.transport.listen(connection_handler=connection_handler, **kws)
+        self._transports_changed()
         return self
     def connect(self, transport_class=transport.SelectUDPTransport, **kws):
         '''
@@ -299,9 +907,11 @@ class ActorManager(messaging.MessageManager):
         '''
         self.transport = transport_class()
         self.transport.connect(**kws)
+        self._transports_changed()
         return self
     def disconnect(self):
         self.transport.disconnect()
+        self._transports_changed()
     def send_message(self, msg, address=None, **kws):
         '''
         send a message to a network
@@ -329,7 +939,10 @@ class ActorManager(messaging.MessageManager):
         transport.send(msg.to_string(), address=address, **kws)
         return self
     def queue_message_to_group(self, group, msg):
-        '''message is serialized and sent to the group (process) specified'''
+        '''message is serialized and sent to the group (process) specified, or to one of the workers of a process pool'''
+        pool = self.pools.get(group)
+        if pool is not None:
+            group = pool.choose(msg)
         if not self.groups.has_key(group):
             raise GroupDoesNotExist('Group "%s" does not exist' % group)
         p, _clientid, switch = self.groups[group]
@@ -340,6 +953,16 @@ class ActorManager(messaging.MessageManager):
             raise PacketTypeError('Packet_type must be specified by class "%s"' % type(msg))
         self.transport.send(msg.to_string(), broadcast=True)
         return self
+    def ipc_packet_handler(self, packet, address):
+        packetid = ord(packet[0])
+        if packetid == _BACKLOG_PACKET:
+            pool, worker = self._pool_clients[address]
+            pool.update_backlog(worker, *struct.unpack(_BACKLOG_FORMAT, packet)[1:])
+            return self
+        if packetid == _WAKE_PACKET:
+            return self
+        self._ipc_received += 1
+        return self.packet_handler(packet, address)
     def packet_handler(self, packet, address):
         packetid = ord(packet[0])
         if packetid < 100:
@@ -349,6 +972,80 @@ class ActorManager(messaging.MessageManager):
         p.sender = address
         self.queue_message(p)
         return self
+    def fair_packet_handler(self, packet, address):
+        '''network packet handler used while fair queuing is enabled, keeps the message in its sender's backlog'''
+        packetid = ord(packet[0])
+        if packetid < 100:
+            processing.get_logger().warning('internal packet unhandled: "%s"' % self.transport.packet_type_info(packetid))
+            return self
+        p = self.packet_types[packetid]().from_string(packet)
+        p.sender = address
+        fair = self.fair_input
+        # stop reading from a sender whose backlog is full, if the transport can
+        if fair.push(address, p) >= fair.backlog_limit and address not in fair.paused:
+            if self.transport.pause_peer(address):
+                fair.paused.add(address)
+                self._transports_changed()
+        return self
+    def enable_fair_queuing(self, quantum=1, backlog_limit=64, budget=None):
+        '''
+        queues network messages per sender and releases them by deficit round robin, 
+        so that a flooding peer does not starve the others
+        
+        a sender whose backlog reaches ``backlog_limit`` is not read from until its backlog drains, 
+        on transports that support it (SelectTCPTransport)
+        
+        :Parameters:
+            - `quantum`: messages released per sender per round, multiplied by the sender's weight
+            - `backlog_limit`: backlog length at which reading from a sender is paused
+            - `budget`: optional.  at most this many network messages are released per tick, all of them otherwise
+        '''
+        if self.fair_input is None:
+            self.fair_input = _FairInput(quantum, backlog_limit, budget)
+        else:
+            fair = self.fair_input
+            fair.quantum, fair.backlog_limit, fair.budget = quantum, backlog_limit, budget
+        return self.fair_input
+    def disable_fair_queuing(self):
+        '''queues the pending backlogs in round robin order and goes back to queuing network messages on arrival'''
+        fair = self.fair_input
+        if fair is None:
+            return
+        fair.budget = None
+        self._release_fair_input()
+        self.fair_input = None
+    def set_peer_weight(self, address, weight):
+        '''
+        sets the share of a sender relative to the others, 1 by default.  
+        a peer with weight 2 gets twice as many messages released per round
+        '''
+        if self.fair_input is None:
+            self.enable_fair_queuing()
+        self.fair_input.weights[address] = weight
+    def get_peer_stats(self):
+        '''
+        returns per sender statistics of the fair queue: 
+        {address: {'backlog': n, 'received': n, 'released': n, 'weight': w, 'paused': bool}}
+        '''
+        if self.fair_input is None:
+            return {}
+        return self.fair_input.get_stats()
+    def _release_fair_input(self):
+        fair = self.fair_input
+        for address, msg in fair.release(self.is_over_high_water_mark):
+            self.queue_message(msg)
+        if fair.paused:
+            resumed = [address for address in fair.paused if fair.backlog_length(address) < fair.backlog_limit]
+            for address in resumed:
+                fair.paused.discard(address)
+                if self.transport:
+                    self.transport.resume_peer(address)
+            if resumed:
+                self._transports_changed()
+    def next_tick_delay(self):
+        if self.fair_input is not None and self.fair_input.active:
+            return 0
+        return super(ActorManager, self).next_tick_delay()
     def register_packet_type(self, packet_class):
         # skip the base packet class
         if packet_class.__name__ == 'Message':
@@ -380,26 +1077,87 @@ class ActorManager(messaging.MessageManager):
         self._ipc_listen()
         # make sure we have a str
         g = str(name)
-        if self.groups.has_key(g):
+        if self.groups.has_key(g) or self.pools.has_key(g):
             raise GroupAlreadyExists('Group name "%s" already exists.' % g) 
+        self._start_group(g, default_actor_class, max_tick_time, interval)
+    def _start_group(self, g, default_actor_class, max_tick_time, interval, report_backlog=False):
         server_addr = self.ipc_transport.address
         # shared should quit switch
         switch = processing.Value('B', 0)
         actor_class = default_actor_class or DefaultActor
-        p = processing.Process(target=_subprocess_main, name=name, args=(name, actor_class, max_tick_time, interval, server_addr, switch, self.packet_types))
+        p = processing.Process(target=_subprocess_main, name=g, args=(g, actor_class, max_tick_time, interval, server_addr, switch, self.packet_types, report_backlog))
         p.start()
-        processing.get_logger().info('started group "%s" in process "%s"' % (name, processing.get_pid(p)))
+        processing.get_logger().info('started group "%s" in process "%s"' % (g, processing.get_pid(p)))
         _clientid = self.ipc_transport.accept()
         self.groups[g] = (p, _clientid, switch)
+        self._transports_changed()
+        return _clientid
+    def add_process_pool(self, name, size, default_actor_class=None, max_tick_time=None, interval=.03, strategy=POOL_ROUND_ROBIN, key=None):
+        '''
+        adds a pool of identical process groups behind one group name.  messages queued to the pool with 
+        "queue_message_to_group" go to one of its workers, the workers are groups named "<name>.<index>"
+        
+        :Parameters:
+            - `size`: the number of worker processes
+            - `strategy`: how the worker of a message is picked: POOL_ROUND_ROBIN, POOL_LEAST_BACKLOG (the worker with 
+              the fewest messages sent to it and not processed yet) or POOL_KEY_HASH (messages with the same key 
+              always go to the same worker, keeping their order)
+            - `key`: for POOL_KEY_HASH, the message property to hash or a callable returning the key of a message
+        '''
+        assert self.is_main_process, 'Pysage currently only supports spawning child groups from the Main Group'
+        if strategy not in (POOL_ROUND_ROBIN, POOL_LEAST_BACKLOG, POOL_KEY_HASH):
+            raise ValueError('Unknown pool strategy "%s"' % strategy)
+        if strategy == POOL_KEY_HASH and key is None:
+            raise ValueError('Pool strategy "%s" requires a key' % strategy)
+        self.validate_groups_mode()
+        self._ipc_listen()
+        g = str(name)
+        if self.groups.has_key(g) or self.pools.has_key(g):
+            raise GroupAlreadyExists('Group name "%s" already exists.' % g)
+        workers = ['%s.%s' % (g, i) for i in range(size)]
+        for worker in workers:
+            if self.groups.has_key(worker):
+                raise GroupAlreadyExists('Group name "%s" already exists.' % worker)
+        pool = self.pools[g] = _ProcessPool(g, workers, strategy, key)
+        for worker in workers:
+            self._pool_clients[self._start_group(worker, default_actor_class, max_tick_time, interval, strategy == POOL_LEAST_BACKLOG)] = (pool, worker)
+        return self
+    def get_pool_stats(self, name):
+        '''returns {worker group: {'sent': n, 'backlog': n}}, the backlog is only tracked by POOL_LEAST_BACKLOG pools'''
+        if not self.pools.has_key(name):
+            raise GroupDoesNotExist('Group "%s" does not exist' % name)
+        pool = self.pools[name]
+        return dict((worker, {'sent': pool.sent[worker], 'backlog': pool.backlog(worker)}) for worker in pool.workers)
+    def _report_backlog(self):
+        '''sends the messages received from and still queued for the main group if they changed since the last report'''
+        report = (self._ipc_received, self.get_message_count())
+        if report != self._last_backlog_report:
+            self._last_backlog_report = report
+            _clientid = self.groups[self.PYSAGE_MAIN_GROUP][1]
+            self.ipc_transport.send(struct.pack(_BACKLOG_FORMAT, _BACKLOG_PACKET, *report), _clientid)
     def remove_process_group(self, name):
-        '''removes a process group from the pool'''
+        '''removes a process group, or all workers of a process pool, from the pool'''
+        pool = self.pools.pop(name, None)
+        if pool is not None:
+            for worker in list(pool.workers):
+                self.remove_process_group(worker)
+            return self
         if not self.groups.has_key(name):
             raise GroupDoesNotExist('Group "%s" does not exist' % name)
         p, _clientid, switch = self.groups[name]
         switch.value = 1
+        # the child may be blocked waiting for packets
+        try:
+            self.ipc_transport.send(chr(_WAKE_PACKET), _clientid)
+        except (IOError, EOFError, OSError):
+            pass
         p.join()
         self.ipc_transport.disconnect(_clientid)
         del self.groups[name]
+        pool, worker = self._pool_clients.pop(_clientid, (None, None))
+        if pool is not None:
+            pool.remove(worker)
+        self._transports_changed()
         return self
     def clear_process_group(self):
         '''shuts down all children processes'''
@@ -408,23 +1166,48 @@ class ActorManager(messaging.MessageManager):
             for name in self.groups.keys():
                 self.remove_process_group(name)
         self.groups = {}
+        self.pools = {}
+        self._pool_clients = {}
     @property
     def queue_length(self):
-        return len(self.active_queue)
+        return self.get_message_count()
     def reset_to_client_mode(self):
         '''after forking in *nix systems, we need to clean up the current manager'''
         super(ActorManager, self).reset_to_client_mode()
         self.is_main_process = False
         self.groups = {}
+        self.pools = {}
+        self._pool_clients = {}
+        self._ipc_received = 0
+        self._last_backlog_report = None
         self.ipc_transport = transport.IPCTransport()
         self.objectIDMap = {}
         self.objectNameMap = {}
+        self.actorNames = {}
         self.transport = None
+        # the parent's event loop is not ours to touch (its selector may be shared after forking)
+        self.event_loop = None
+        self._loop_handle = self._loop_handle_due = None
+        self._loop_readers = set()
+        self._wakeup = self._ingress_wakeup = None
+        # the wakeup pipe is shared with the parent after forking
+        if self._wakeup_pipe is not None:
+            for fd in self._wakeup_pipe:
+                os.close(fd)
+        self._wakeup_pipe = None
+        self._selector = None
+        self._network_selectable = False
+        self.fair_input = None
+        self._reset_updates()
     def reset(self):
         '''mainly used for testing'''
+        self.detach_event_loop()
         messaging.MessageManager.reset(self)
         self.objectIDMap = {}
         self.objectNameMap = {}
+        self.actorNames = {}
+        self.fair_input = None
+        self._reset_updates()
         
         self.clear_process_group()
         self.gid = 0
@@ -437,8 +1220,181 @@ class ActorManager(messaging.MessageManager):
         self.groups = {}
         self.ipc_transport = transport.IPCTransport()
                 
+def _mix_hash(value):
+    '''spreads ``hash(value)`` over 64 bits, the hash of small integers is the integer itself'''
+    return (hash(value) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+
+class _ProcessPool(object):
+    '''the worker groups behind a pool name, see ActorManager.add_process_pool'''
+    # points of each worker on the key hash ring
+    ring_points = 64
+    def __init__(self, name, workers, strategy, key):
+        self.name = name
+        self.workers = workers
+        self.strategy = strategy
+        self.key = key
+        self.next = 0
+        # worker -> messages sent to it, and the (received, queued) it last reported
+        self.sent = dict((worker, 0) for worker in workers)
+        self.reports = dict((worker, (0, 0)) for worker in workers)
+        self._build_ring()
+    def _build_ring(self):
+        '''places the workers on a consistent hash ring, removing a worker only moves the keys it had'''
+        ring = sorted((_mix_hash((worker, i)), worker) for worker in self.workers for i in xrange(self.ring_points))
+        self.ring = [point for point, worker in ring]
+        self.ring_workers = [worker for point, worker in ring]
+    def backlog(self, worker):
+        '''messages sent to the worker that it did not receive yet or still has queued'''
+        received, queued = self.reports[worker]
+        return self.sent[worker] - received + queued
+    def update_backlog(self, worker, received, queued):
+        if worker in self.reports:
+            self.reports[worker] = (received, queued)
+    def choose(self, msg):
+        '''returns the worker the message goes to'''
+        workers = self.workers
+        if not workers:
+            raise GroupDoesNotExist('Process pool "%s" has no workers' % self.name)
+        if self.strategy == POOL_KEY_HASH:
+            if callable(self.key):
+                key = self.key(msg)
+            else:
+                key = msg.get_property(self.key)
+            worker = self.ring_workers[bisect.bisect(self.ring, _mix_hash(key)) % len(self.ring)]
+        elif self.strategy == POOL_LEAST_BACKLOG:
+            # ties go round robin, so that idle workers share the load
+            count = len(workers)
+            worker = min((workers[(self.next + i) % count] for i in range(count)), key=self.backlog)
+            self.next = (workers.index(worker) + 1) % count
+        else:
+            worker = workers[self.next % len(workers)]
+            self.next = (self.next + 1) % len(workers)
+        self.sent[worker] += 1
+        return worker
+    def remove(self, worker):
+        if worker in self.workers:
+            self.workers.remove(worker)
+            del self.sent[worker]
+            del self.reports[worker]
+            self._build_ring()
+
+class _FairInput(object):
+    '''per sender backlogs of network messages released by deficit round robin, see ActorManager.enable_fair_queuing'''
+    def __init__(self, quantum, backlog_limit, budget):
+        self.quantum = quantum
+        self.backlog_limit = backlog_limit
+        self.budget = budget
+        # address -> deque of messages not queued yet
+        self.backlogs = {}
+        # senders with a backlog, in round robin order, and the part of their quantum they did not use
+        self.active = collections.deque()
+        self.deficits = {}
+        self.weights = {}
+        self.received = {}
+        self.released = {}
+        # senders the transport stopped reading from
+        self.paused = set()
+    def push(self, address, msg):
+        '''adds the message to its sender's backlog, returns the backlog length'''
+        backlog = self.backlogs.get(address)
+        if backlog is None:
+            backlog = self.backlogs[address] = collections.deque()
+            self.active.append(address)
+            self.deficits[address] = 0
+        backlog.append(msg)
+        self.received[address] = self.received.get(address, 0) + 1
+        return len(backlog)
+    def forget(self, address):
+        '''drops the entries of a disconnected sender, the messages it sent before are still released'''
+        self.paused.discard(address)
+        self.weights.pop(address, None)
+        self.received.pop(address, None)
+        self.released.pop(address, None)
+    def backlog_length(self, address):
+        backlog = self.backlogs.get(address)
+        return backlog and len(backlog) or 0
+    def release(self, is_full=None):
+        '''yields (address, message) in deficit round robin order until the budget is used, the backlogs are empty or ``is_full()``'''
+        active = self.active
+        left = self.budget
+        while active:
+            if left is not None and left <= 0 or is_full and is_full():
+                return
+            address = active.popleft()
+            backlog = self.backlogs[address]
+            deficit = self.deficits[address] + self.quantum * self.weights.get(address, 1)
+            count = 0
+            while backlog and deficit >= 1:
+                if left is not None and count >= left or is_full and is_full():
+                    break
+                count += 1
+                deficit -= 1
+                yield address, backlog.popleft()
+            if left is not None:
+                left -= count
+            # a forgotten sender's remaining backlog is not counted
+            if address in self.received:
+                self.released[address] = self.released.get(address, 0) + count
+            if not backlog:
+                # an idle sender does not bank its unused quantum
+                del self.backlogs[address]
+                del self.deficits[address]
+            elif deficit >= 1:
+                # stopped by the budget, it resumes its turn first next time
+                self.deficits[address] = deficit - self.quantum * self.weights.get(address, 1)
+                active.appendleft(address)
+            else:
+                self.deficits[address] = deficit
+                active.append(address)
+    def get_stats(self):
+        peers = set(self.received) | set(self.weights)
+        return dict((address, {'backlog': self.backlog_length(address),
+                               'received': self.received.get(address, 0),
+                               'released': self.released.get(address, 0),
+                               'weight': self.weights.get(address, 1),
+                               'paused': address in self.paused}) for address in peers)
+
+class _ActorTimer(object):
+    '''timer of an actor, see ActorManager.schedule_every'''
+    __slots__ = ('actor', 'interval', 'callback', 'args', 'repeat', 'entry')
+    def __init__(self, actor, interval, callback, args, repeat):
+        self.actor = actor
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.repeat = repeat
+        # the manager's timer heap entry of the next call
+        self.entry = None
+
+class _WakingHandler(object):
+    '''dispatch table entry of a sleeping actor, wakes the actor up before calling its handler'''
+    __slots__ = ('manager', 'actor', 'handler')
+    def __init__(self, manager, actor, handler):
+        self.manager = manager
+        self.actor = actor
+        self.handler = handler
+    def __call__(self, msg):
+        self.manager.wake_actor(self.actor)
+        return self.handler(msg)
+
 class Actor(messaging.MessageReceiver):
     '''actor class extends the message receiver class to provide actor like functionality'''
+    # how often "update" is called, read on registration: every "update_every" ticks, 
+    # or if set, every "update_interval" seconds
+    update_every = 1
+    update_interval = None
+    def sleep(self):
+        '''stops updates until the next message is delivered to this actor'''
+        return ActorManager.get_singleton().sleep_actor(self)
+    def schedule_every(self, interval, callback, *args):
+        '''calls ``callback(*args)`` every ``interval`` seconds until the actor is unregistered, see ActorManager.schedule_every'''
+        return ActorManager.get_singleton().schedule_every(self, interval, callback, *args)
+    def schedule_once(self, delay, callback, *args):
+        '''calls ``callback(*args)`` after ``delay`` seconds unless the actor is unregistered by then'''
+        return ActorManager.get_singleton().schedule_once(self, delay, callback, *args)
+    def cancel_timer(self, timer):
+        '''cancels a timer returned by schedule_every or schedule_once'''
+        return ActorManager.get_singleton().cancel_actor_timer(timer)
     @property
     def gid(self):
         '''return a globally unique id that is good cross processes'''
@@ -451,15 +1407,56 @@ class DefaultActor(Actor):
         processing.get_logger().info('Default actor received message "%s"' % msg)
         return False
 
+_PROPERTY_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_RESERVED_PROPERTY_NAMES = ('self', 'sender', 'receiverID', 'message_type')
+
+def _property_slot(name):
+    '''compact messages store each property in a slot of this name'''
+    return '_p_' + name
+
+def _make_compact_init(class_name, properties):
+    '''generates an __init__ that assigns every property slot directly'''
+    for name in properties:
+        if not _PROPERTY_NAME.match(name) or name in _RESERVED_PROPERTY_NAMES:
+            raise messaging.InvalidMessageProperty('Compact message "%s" cannot have a property named "%s"' % (class_name, name))
+    args = ''.join(", %s=None" % name for name in properties)
+    assignments = ''.join("    self.%s = %s\n" % (_property_slot(name), name) for name in properties)
+    source = ("def __init__(self, sender=None, receiverID=None, message_type=''%s):\n"
+              "    self.sender = sender\n"
+              "    self.receiverID = receiverID\n"
+              "    self._message_type = message_type\n"
+              "    self.reply_to = None\n"
+              "    self.gid = next_message_id()\n"
+              "    self.deadline = None\n"
+              "    if self.ttl is not None:\n"
+              "        self.deadline = get_time() + self.ttl\n"
+              "%s") % (args, assignments)
+    namespace = {'next_message_id': messaging.next_message_id, 'get_time': util.get_time}
+    exec source in namespace
+    return namespace['__init__']
+
 class AutoMessageRegister(type):
-    '''metaclass that auto register all message classes with the actor manager'''
+    '''metaclass that auto register all message classes with the actor manager
+    
+       subclasses of ``CompactMessage`` are also given one slot per property and a specialized ``__init__``
+    '''
+    def __new__(mcs, name, bases, dct):
+        if '__slots__' not in dct and [b for b in bases if getattr(b, 'compact', False)]:
+            properties = list(dct.get('properties', [p for b in bases for p in getattr(b, 'properties', [])]))
+            existing = set(s for b in bases for k in b.__mro__ for s in k.__dict__.get('__slots__', ()))
+            dct['__slots__'] = tuple(_property_slot(p) for p in properties if _property_slot(p) not in existing)
+            dct['_property_slots'] = dict((p, _property_slot(p)) for p in properties)
+            if '__init__' not in dct:
+                dct['__init__'] = _make_compact_init(name, properties)
+        return super(AutoMessageRegister, mcs).__new__(mcs, name, bases, dct)
     def __init__(cls, name, bases, dct):
         super(AutoMessageRegister, cls).__init__(name, bases, dct)
         ActorManager.get_singleton().register_packet_type(cls)
         
-class Message(messaging.Message):
-    '''extends messaging.Message to provide network functionality'''
+class NetworkMessageBase(messaging.MessageBase):
+    '''network functionality of messages, without an instance dictionary so that CompactMessage can derive from it'''
     __metaclass__ = AutoMessageRegister
+    __slots__ = ()
     types = []
     packet_type = None
     def to_string(self):
@@ -468,11 +1465,12 @@ class Message(messaging.Message):
             raise WrongMessageTypeSpecified('Message "%s" has %s properties, but %s types specified.  Check the "types" and "properties" class attribute of the "%s" class' % (self, len(self.properties), len(self.types), type(self)))
         # first encode the message type identifier
         buf = struct.pack('!B', self.packet_type)
+        properties = self._properties
         # iterate thru all attributes
         for i,_type in enumerate(self.types):
             # get name and value of the attribute
             name = self.properties[i]
-            value = self._properties[name]
+            value = properties[name]
             # for composite type, pack it looping over each subtype
             if type(_type) == type(()):
                 pack_func = getattr(self, 'pack_' + name, None)
@@ -489,6 +1487,9 @@ class Message(messaging.Message):
                     buf = self.pack_attr(_type, buf, pack_func(value), name)
                 else:
                     buf = self.pack_attr(_type, buf, value, name)
+        # the deadline travels as the time left, so that the clocks of both ends do not need to agree
+        if self.deadline is not None:
+            buf += _DEADLINE_MARKER + struct.pack(_DEADLINE_FORMAT, max(0.0, self.deadline - util.get_time()))
         return buf
     def from_string(self, data):
         '''unpacks the property data into the object, from binary stream'''
@@ -520,6 +1521,10 @@ class Message(messaging.Message):
                     self.set_property(name, unpack_func(value))
                 else:
                     self.set_property(name, value)
+        # the optional trailer is the time left before the deadline, messages without one are packed as they always were
+        if pos + _DEADLINE_SIZE == len(data) and data[pos] == _DEADLINE_MARKER:
+            self.deadline = util.get_time() + struct.unpack(_DEADLINE_FORMAT, data[pos + 1:])[0]
+            pos += _DEADLINE_SIZE
         if pos != len(data):
             raise PacketError('incorrect length upon unpacking %s: got %i expected %i' % (self.__class__.__name__, len(data), pos))
         return self
@@ -592,3 +1597,61 @@ class Message(messaging.Message):
                 raise PacketError('Error unpacking "%s": %s' % (self.__class__.__name__, err))
         return value, size
 
+class Message(NetworkMessageBase, messaging.Message):
+    '''extends messaging.Message to provide network functionality'''
+
+class CompactMessage(NetworkMessageBase):
+    '''opt-in message base that keeps its state in slots instead of dictionaries
+    
+       the metaclass gives every subclass one slot per entry in ``properties`` and an ``__init__`` that
+       takes the properties as keyword arguments.  Unlike ``Message``, unknown properties are rejected
+       at construction time, and so are attributes that are not slots.  
+       Compact messages are not instances of ``Message``, check for ``messaging.MessageBase`` to accept both.
+    '''
+    __slots__ = ('sender', 'gid', 'receiverID', '_message_type', 'reply_to', 'queued_at', 'deadline')
+    compact = True
+    _property_slots = {}
+    def __init__(self, sender=None, receiverID=None, message_type=''):
+        self.sender = sender
+        self.receiverID = receiverID
+        self._message_type = message_type
+        self.reply_to = None
+        self.gid = messaging.next_message_id()
+        self.deadline = None
+        if self.ttl is not None:
+            self.deadline = util.get_time() + self.ttl
+    @property
+    def _properties(self):
+        return dict((name, getattr(self, slot)) for name, slot in self._property_slots.iteritems())
+    def lazy_set_property(self, name, value):
+        self.set_property(name, value)
+    def set_property(self, name, value):
+        '''set required property of the message'''
+        try:
+            setattr(self, self._property_slots[name], value)
+        except KeyError:
+            raise messaging.InvalidMessageProperty('Invalid Message Property: %s' % name)
+    def get_property(self, name, default=None):
+        '''get a given property from the message, if the retrieved property is None, ``default`` is returned'''
+        try:
+            value = getattr(self, self._property_slots[name])
+        except KeyError:
+            raise messaging.InvalidMessageProperty('Invalid Message Property: %s' % name)
+        if value is None:
+            return default
+        return value
+    def validate(self):
+        '''the property set of a compact message is fixed by its slots, so it is always valid'''
+        return True
+    def __getstate__(self):
+        return {'gid': self.gid, 'receiverID': self.receiverID, '_message_type': self._message_type,
+                'deadline': self.deadline, '_properties': self._properties}
+    def __setstate__(self, d):
+        self.gid = d['gid']
+        self.receiverID = d['receiverID']
+        self.sender = None
+        self._message_type = d['_message_type']
+        self.reply_to = None
+        self.deadline = d['deadline']
+        for name, value in d['_properties'].iteritems():
+            self.set_property(name, value)
@@ -6,6 +6,7 @@ import struct
 import time
 import os
 import datetime
+import errno
 
 try:
     import pyraknet
@@ -39,11 +40,75 @@ class Transport(object):
     def packet_type_info(self, packet_type_id):
         '''returns information about the packet type'''
         pass
+    def filenos(self):
+        '''returns the file descriptors that become readable when "poll" has data, empty if the transport cannot be waited on'''
+        return []
+    def pause_peer(self, address):
+        '''stops reading from a peer until "resume_peer", returns false if the transport cannot'''
+        return False
+    def resume_peer(self, address):
+        '''reads from a paused peer again'''
+        return False
+    def pop_disconnected(self):
+        '''returns the addresses of the peers that disconnected since the last call'''
+        return []
     @property
     def address(self):
         '''returns the address this transport is bound to'''
         pass
     
+class Selector(object):
+    '''
+    waits on many file descriptors with a single "poll" call (or "select" where poll is not available)
+    
+    the registration lives in the process, not in the kernel like epoll's, so a file descriptor closed and 
+    reused by a new socket needs no bookkeeping and the selector survives forking
+    '''
+    def __init__(self):
+        # fd -> data returned by "select" when the fd is readable
+        self.fds = {}
+        if hasattr(select, 'poll'):
+            self._poll = select.poll()
+        else:
+            self._poll = None
+    def __len__(self):
+        return len(self.fds)
+    def register(self, fd, data=None):
+        if self._poll is not None and not fd in self.fds:
+            self._poll.register(fd, select.POLLIN | select.POLLPRI)
+        self.fds[fd] = data
+    def unregister(self, fd):
+        if fd in self.fds:
+            del self.fds[fd]
+            if self._poll is not None:
+                self._poll.unregister(fd)
+    def update(self, fds):
+        '''registers exactly the given {fd: data}'''
+        for fd in [fd for fd in self.fds if not fd in fds]:
+            self.unregister(fd)
+        for fd, data in fds.iteritems():
+            if self.fds.get(fd, self) != data:
+                self.register(fd, data)
+    def select(self, timeout=None):
+        '''
+        waits until some of the file descriptors are readable (or closed), at most ``timeout`` seconds if not None
+        
+        :Return: the data of the readable file descriptors
+        '''
+        try:
+            if self._poll is not None:
+                if timeout is not None:
+                    timeout = int(timeout * 1000 + .999)
+                ready = [fd for fd, event in self._poll.poll(timeout)]
+            else:
+                ready = select.select(list(self.fds), [], [], timeout)[0]
+        except (select.error, IOError, OSError), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+        fds = self.fds
+        return [fds[fd] for fd in ready if fd in fds]
+
 class RawPacket(object):
     def __init__(self, data):
         self.data = data
@@ -76,6 +141,10 @@ class SelectUDPTransport(Transport):
         self.socket.setblocking(False)
         self.socket.connect((host, port))
         self._is_connected = True
+    def filenos(self):
+        if self.socket:
+            return [self.socket.fileno()]
+        return []
     def disconnect(self):
         self.socket.close()
     def send(self, data, address=None, broadcast=False):
@@ -188,6 +257,10 @@ class SelectTCPTransport(Transport):
         self._is_server = False
         self.outgoing_queue = []
         self.incoming_queue = []
+        # sockets not read from, see pause_peer
+        self.paused = set()
+        # addresses of the peers closed since the last pop_disconnected
+        self.disconnected = []
     def listen(self, host, port, connection_handler=None):
         logger.info("server pid %s listening..." % os.getpid())
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -198,6 +271,12 @@ class SelectTCPTransport(Transport):
         self._is_connected = True
     def is_server(self):
         return self._is_connected and self._is_server
+    def filenos(self):
+        if self.is_server():
+            return [self.socket.fileno()] + [s.fileno() for s in self.peers if not s in self.paused]
+        elif self.is_client() and not self.socket in self.paused:
+            return [self.socket.fileno()]
+        return []
     def is_client(self):
         return self._is_connected and not self._is_server
     def process_received_data(self, sock, addr, data, packet_handler):
@@ -212,25 +291,31 @@ class SelectTCPTransport(Transport):
                 length = struct.unpack("!L", buf[:size])[0]
         
         # if length is defined, we've decoded the message length already
-        if length:
+        while length:
             # if we've got the complete message, then handle it and remove it from the buffer
-            if len(buf) >= (length + size):
-                packet_handler(buf[size:length+size], addr)
-                buf = buf[length + size:]
-                length = None
+            if len(buf) < (length + size):
+                break
+            packet_handler(buf[size:length+size], addr)
+            buf = buf[length + size:]
+            length = None
+            # the same read may hold more messages
+            if len(buf) >= size:
+                length = struct.unpack("!L", buf[:size])[0]
         # if we haven't gotten the complete message, just hang tight
         self.buffer[sock] = (buf, length)
     def remove_socket(self, sock):
+        self.disconnected.extend(addr for addr, s in self.addrs.items() if s == sock)
         self.addrs = dict(addr for addr in self.addrs.items() if not addr[1] == sock)
         if sock in self.peers:
             self.peers.remove(sock)
         if sock in self.buffer:
             del self.buffer[sock]
+        self.paused.discard(sock)
     def poll_server(self, packet_handler):
 #        logger.debug('server pid %s polling...' % os.getpid())
         processed = False
         try:
-            inputready, outputready, exceptready = select.select([self.socket] + self.peers, [], [], 0)
+            inputready, outputready, exceptready = select.select([self.socket] + [s for s in self.peers if not s in self.paused], [], [], 0)
         except select.error, e:
             logger.error('Error with network select: %s' % e)
             return processed
@@ -278,6 +363,8 @@ class SelectTCPTransport(Transport):
     def poll_client(self, packet_handler):
 #        logger.debug('client pid %s polling...' % os.getpid())
         processed = False
+        if self.socket in self.paused:
+            return processed
         try:
             inputready, outputready, exceptready = select.select([self.socket], [], [], 0)
         except select.error, e:
@@ -317,6 +404,22 @@ class SelectTCPTransport(Transport):
         self.socket.close()
         self._is_connected = False
         self._is_server = False
+    def pause_peer(self, address):
+        '''stops reading from the peer, TCP flow control then slows its sending down'''
+        sock = self.addrs.get(address)
+        if sock is None:
+            return False
+        self.paused.add(sock)
+        return True
+    def resume_peer(self, address):
+        sock = self.addrs.get(address)
+        if sock is None or not sock in self.paused:
+            return False
+        self.paused.discard(sock)
+        return True
+    def pop_disconnected(self):
+        disconnected, self.disconnected = self.disconnected, []
+        return disconnected
     def send(self, data, address=None, broadcast=False):
 #        logger.debug('%s pid %s sending...%s' % ('server' if self.is_server() else 'client', os.getpid(), time.time()))
         data = struct.pack("!L",len(data)) + data
@@ -360,16 +463,25 @@ class IPCTransport(Transport):
         return _clientid
     def disconnect(self, _id):
         del self.peers[_id]
+    def filenos(self):
+        return [conn.fileno() for conn in self.peers.values()]
+    def peer_filenos(self):
+        '''returns {file descriptor: peer id}'''
+        return dict((conn.fileno(), _id) for _id, conn in self.peers.iteritems())
     def send(self, data, id=-1, broadcast=False):
         return processing.send_bytes(self.peers[id], data)
     def poll(self, packet_handler):
         '''returns True if transport processed any packet at all'''
-        processed = False
-        for address, conn in self.peers.items():
-            if conn.poll():
+        return bool(self.poll_peers(packet_handler, self.peers.keys()))
+    def poll_peers(self, packet_handler, ids):
+        '''reads one packet from each of the given peers that has one, returns the ids of those peers'''
+        processed = []
+        for _id in ids:
+            conn = self.peers.get(_id)
+            if conn is not None and conn.poll():
                 packet = processing.recv_bytes(conn)
-                packet_handler(packet, address)
-                processed = True
+                packet_handler(packet, _id)
+                processed.append(_id)
         return processed
 
 class RakNetTransport(Transport):
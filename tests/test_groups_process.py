@@ -1,6 +1,8 @@
 # test_groups_process.py
 from pysage.system import *
 import time
+import os
+import threading
 
 processing = None
 
@@ -72,6 +74,32 @@ class PongReceiver(Actor):
         self.received_secret = msg.get_property('secret')
         return True
 
+class WorkRequest(Message):
+    properties = ['job']
+    types = ['i']
+    packet_type = 121
+
+class WorkDone(Message):
+    properties = ['job', 'pid']
+    types = ['i', 'i']
+    packet_type = 122
+
+class Worker(Actor):
+    subscriptions = ['WorkRequest']
+    def handle_WorkRequest(self, msg):
+        nmanager = ActorManager.get_singleton()
+        nmanager.queue_message_to_group(nmanager.PYSAGE_MAIN_GROUP, WorkDone(job=msg.get_property('job'), pid=os.getpid()))
+        return True
+
+class WorkCollector(Actor):
+    subscriptions = ['WorkDone']
+    def __init__(self):
+        Actor.__init__(self)
+        self.done = {}
+    def handle_WorkDone(self, msg):
+        self.done[msg.get_property('job')] = msg.get_property('pid')
+        return True
+
 class TestGroupsProcess(unittest.TestCase):
     def setUp(self):
         nmanager.enable_groups()
@@ -171,6 +199,98 @@ class TestGroupsProcess(unittest.TestCase):
         nmanager.tick()
 
         assert nmanager.find('pong_receiver').received_secret == 10000
+    def test_child_wakes_up_on_message(self):
+        '''an idle child blocks on its connection instead of sleeping out its interval'''
+        receiver = nmanager.register_actor(PongReceiver())
+        nmanager.add_process_group('a', PingReceiver, interval=2.0)
+        time.sleep(.5)
+        start = time.time()
+        nmanager.queue_message_to_group('a', PingMessage(secret=1234))
+        while not receiver.received_secret and time.time() - start < 2.0:
+            nmanager.tick()
+            time.sleep(.01)
+        assert receiver.received_secret == 1234
+        assert time.time() - start < 1.0
+        # removing the group wakes it up as well
+        start = time.time()
+        nmanager.remove_process_group('a')
+        assert time.time() - start < 1.0
+    def test_wait(self):
+        receiver = nmanager.register_actor(PongReceiver())
+        nmanager.add_process_group('a', PingReceiver)
+        nmanager.add_process_group('b')
+        # nothing to do, the timeout passes
+        start = time.time()
+        assert nmanager.wait(.2) == False
+        assert time.time() - start >= .15
+        # a reply from a group
+        nmanager.queue_message_to_group('a', PingMessage(secret=1234))
+        start = time.time()
+        assert nmanager.wait(5.0) == True
+        assert time.time() - start < 1.0
+        while not receiver.received_secret and time.time() - start < 2.0:
+            nmanager.tick()
+        assert receiver.received_secret == 1234
+        # a message posted from another thread
+        receiver.received_secret = None
+        threading.Timer(.1, nmanager.post_message, (PongMessage(secret=5678),)).start()
+        start = time.time()
+        assert nmanager.wait(5.0) == True
+        assert time.time() - start < 1.0
+        nmanager.tick()
+        assert receiver.received_secret == 5678
+    def test_process_pool_round_robin(self):
+        collector = nmanager.register_actor(WorkCollector())
+        nmanager.add_process_pool('workers', 3, Worker)
+        assert sorted(nmanager.groups) == ['workers.0', 'workers.1', 'workers.2']
+        self.assertRaises(GroupAlreadyExists, nmanager.add_process_group, 'workers')
+        for i in range(6):
+            nmanager.queue_message_to_group('workers', WorkRequest(job=i))
+        time.sleep(1)
+        nmanager.tick()
+        assert len(collector.done) == 6
+        assert len(set(collector.done.values())) == 3
+        for i in range(3):
+            assert collector.done[i] == collector.done[i + 3]
+        nmanager.remove_process_group('workers')
+        assert not nmanager.groups
+        assert len(active_children()) == 0
+    def test_process_pool_key_hash(self):
+        collector = nmanager.register_actor(WorkCollector())
+        self.assertRaises(ValueError, nmanager.add_process_pool, 'workers', 2, Worker, strategy=POOL_KEY_HASH)
+        nmanager.add_process_pool('workers', 2, Worker, strategy=POOL_KEY_HASH, key=lambda msg: msg.get_property('job') % 2)
+        for i in range(8):
+            nmanager.queue_message_to_group('workers', WorkRequest(job=i))
+        time.sleep(1)
+        nmanager.tick()
+        assert len(collector.done) == 8
+        assert set(collector.done[i] for i in range(0, 8, 2)) == set([collector.done[0]])
+        assert set(collector.done[i] for i in range(1, 8, 2)) == set([collector.done[1]])
+    def test_process_pool_key_hash_remove(self):
+        from pysage.system import _ProcessPool
+        pool = _ProcessPool('workers', ['workers.%s' % i for i in range(4)], POOL_KEY_HASH, 'job')
+        before = dict((i, pool.choose(WorkRequest(job=i))) for i in range(200))
+        assert len(set(before.values())) == 4
+        pool.remove('workers.2')
+        # only the keys of the removed worker move
+        for i in range(200):
+            if before[i] != 'workers.2':
+                assert pool.choose(WorkRequest(job=i)) == before[i]
+    def test_process_pool_least_backlog(self):
+        collector = nmanager.register_actor(WorkCollector())
+        nmanager.add_process_pool('workers', 2, Worker, strategy=POOL_LEAST_BACKLOG)
+        for i in range(4):
+            nmanager.queue_message_to_group('workers', WorkRequest(job=i))
+        stats = nmanager.get_pool_stats('workers')
+        assert stats['workers.0'] == {'sent': 2, 'backlog': 2}
+        assert stats['workers.1'] == {'sent': 2, 'backlog': 2}
+        time.sleep(1)
+        nmanager.tick()
+        assert len(collector.done) == 4
+        # the workers reported that they processed everything
+        stats = nmanager.get_pool_stats('workers')
+        assert stats['workers.0']['backlog'] == 0
+        assert stats['workers.1']['backlog'] == 0
         
     
         
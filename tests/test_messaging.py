@@ -1,9 +1,12 @@
 # test_messaging.py
 # unit test that excercises the messaging system
 from pysage.messaging import *
-from pysage.messaging import MessageReceiver, Message, MessageManager
+from pysage.messaging import MessageReceiver, Message, MessageManager, Sleep, WaitForMessage, WaitForReply
+from pysage import util
 import time
+import threading
 import unittest
+import os
 
 messageManager = MessageManager()
 
@@ -11,6 +14,156 @@ class Test(Message):
     properties = ['name']
     pass
 
+class Urgent(Message):
+    properties = ['name']
+    priority = 10
+
+class OrderReceiver(MessageReceiver):
+    subscriptions = ['Test', 'Urgent']
+    def __init__(self):
+        MessageReceiver.__init__(self)
+        self.received = []
+    def handle_Test(self, msg):
+        self.received.append(msg.get_property('name'))
+        return False
+    def handle_Urgent(self, msg):
+        self.received.append(msg.get_property('name'))
+        return False
+
+class Quote(Message):
+    properties = ['symbol', 'price']
+    conflation_key = ['symbol']
+
+class QuoteReceiver(MessageReceiver):
+    subscriptions = ['Quote']
+    def __init__(self):
+        MessageReceiver.__init__(self)
+        self.quotes = []
+    def handle_Quote(self, msg):
+        self.quotes.append((msg.get_property('symbol'), msg.get_property('price')))
+        return False
+
+class Reply(Message):
+    properties = ['name']
+
+class ConversationReceiver(MessageReceiver):
+    subscriptions = ['Test']
+    def __init__(self):
+        MessageReceiver.__init__(self)
+        self.steps = []
+    def handle_Test(self, msg):
+        self.steps.append('start')
+        yield Sleep(.2)
+        self.steps.append('slept')
+        urgent = yield WaitForMessage('Urgent')
+        self.steps.append(urgent.get_property('name'))
+        reply = yield WaitForReply(msg.gid, timeout=.2)
+        self.steps.append(reply and reply.get_property('name'))
+        reply = yield WaitForReply(msg.gid, timeout=.1)
+        self.steps.append(reply)
+
+class TopicReceiver(MessageReceiver):
+    subscriptions = ['market.*.AAPL', 'market.#']
+    def __init__(self):
+        MessageReceiver.__init__(self)
+        self.received = []
+    def handle_market_any_AAPL(self, msg):
+        self.received.append(('AAPL', msg.message_type))
+        return True
+    def handle_market_all(self, msg):
+        self.received.append(('market', msg.message_type))
+        return False
+    def handle_market_fx_EUR(self, msg):
+        self.received.append(('EUR', msg.message_type))
+        return False
+
+class BlockingReceiver(MessageReceiver):
+    subscriptions = ['Test', 'Reply']
+    def __init__(self):
+        MessageReceiver.__init__(self)
+        self.threads = []
+        self.replies = []
+    @offload
+    def handle_Test(self, msg):
+        time.sleep(.05)
+        self.threads.append(threading.current_thread())
+        return [Reply(name=msg.get_property('name'))]
+    def handle_Reply(self, msg):
+        self.replies.append(msg.get_property('name'))
+        return False
+
+class Crunched(Message):
+    properties = ['name', 'pid']
+
+class CrunchReceiver(MessageReceiver):
+    subscriptions = ['Crunch', 'Crunched']
+    def __init__(self):
+        MessageReceiver.__init__(self)
+        self.results = []
+    @offload(OFFLOAD_PROCESS)
+    @staticmethod
+    def handle_Crunch(msg):
+        return Crunched(name=msg.message_type, pid=os.getpid())
+    def handle_Crunched(self, msg):
+        self.results.append((msg.get_property('name'), msg.get_property('pid')))
+        return False
+
+class BatchReceiver(MessageReceiver):
+    subscriptions = ['Test', 'Urgent']
+    def __init__(self):
+        MessageReceiver.__init__(self)
+        self.calls = []
+    def handle_batch_Test(self, msgs):
+        self.calls.append((msgs.message_type, msgs.column('name')))
+    def handle_Test(self, msg):
+        self.calls.append('single')
+    def handle_Urgent(self, msg):
+        self.calls.append('Urgent')
+        return False
+
+class Requeuer(MessageReceiver):
+    subscriptions = ['Test', 'Urgent']
+    def __init__(self):
+        MessageReceiver.__init__(self)
+        self.received = []
+        self.accepted = None
+    def handle_Test(self, msg):
+        self.received.append(msg.get_property('name'))
+        return False
+    def handle_Urgent(self, msg):
+        self.accepted = messageManager.queue_message(Test(name='new'))
+        return False
+
+class Pos(Message):
+    properties = ['name']
+
+class Hit(Message):
+    properties = ['name']
+
+class PosBatcher(MessageReceiver):
+    subscriptions = ['Pos', 'Hit']
+    def __init__(self):
+        MessageReceiver.__init__(self)
+        self.calls = []
+    def handle_batch_Pos(self, msgs):
+        self.calls.append(msgs.column('name'))
+    def handle_Hit(self, msg):
+        self.calls.append('Hit')
+        messageManager.trigger(Pos(name=msg.get_property('name')))
+        return False
+
+class SlowBatchReceiver(MessageReceiver):
+    subscriptions = ['Test']
+    def handle_batch_Test(self, msgs):
+        time.sleep(.03)
+
+class CapacitySetter(MessageReceiver):
+    subscriptions = ['Test']
+    def handle_Test(self, msg):
+        if 'Test' not in messageManager.queue_limits:
+            messageManager.set_queue_capacity(5, 'Test')
+        return False
+
 class Receiver(MessageReceiver):
     subscriptions = ['Test']
     def handle_Test(self, msg):
@@ -187,6 +340,431 @@ class TestMessage(unittest.TestCase):
         msg = Test(name=None)
         assert msg.get_property('name', 2) == 2
         
+    def test_priorityLanes(self):
+        receiver = OrderReceiver()
+        messageManager.register_receiver(receiver)
+        messageManager.queue_message(Test(name='bulk1'))
+        messageManager.queue_message(Test(name='bulk2'))
+        messageManager.queue_message(Urgent(name='urgent'))
+        messageManager.queue_message(Test(name='control'), priority=5)
+        assert messageManager.get_message_count() == 4
+        assert messageManager.get_message_count(10) == 1
+        assert messageManager.get_message_count(5) == 1
+        assert messageManager.get_message_count(0) == 2
+        assert messageManager.tick()
+        assert receiver.received == ['urgent', 'control', 'bulk1', 'bulk2']
+        
+    def test_priorityLanesLeftOver(self):
+        receiver1 = OrderReceiver()
+        receiver2 = SlowReceiver()
+        messageManager.register_receiver(receiver1)
+        messageManager.register_receiver(receiver2)
+        for i in range(3):
+            messageManager.queue_message(Test(name='bulk%s' % i))
+        messageManager.queue_message(Test(name='control'), priority=5)
+        assert not messageManager.tick(.001)
+        assert receiver1.received == ['control']
+        assert messageManager.get_message_count(0) == 3
+        messageManager.queue_message(Test(name='bulk3'))
+        messageManager.tick(.001)
+        assert receiver1.received == ['control', 'bulk0']
+        messageManager.tick()
+        assert receiver1.received == ['control', 'bulk0', 'bulk1', 'bulk2', 'bulk3']
+        
+    def test_coroutineDirectives(self):
+        receiver = ConversationReceiver()
+        messageManager.register_receiver(receiver)
+        msg = Test(name='hello')
+        messageManager.queue_message(msg)
+        messageManager.tick()
+        assert receiver.steps == ['start']
+        # sleeping coroutines are parked in the timer heap
+        assert len(messageManager.coroutines) == 0
+        messageManager.tick()
+        assert receiver.steps == ['start']
+        time.sleep(.25)
+        messageManager.tick()
+        assert receiver.steps == ['start', 'slept']
+        messageManager.queue_message(Urgent(name='urgent'))
+        messageManager.tick()
+        assert receiver.steps == ['start', 'slept', 'urgent']
+        reply = Reply(name='reply')
+        reply.reply_to = msg.gid
+        messageManager.queue_message(reply)
+        messageManager.tick()
+        assert receiver.steps == ['start', 'slept', 'urgent', 'reply']
+        time.sleep(.15)
+        messageManager.tick()
+        assert receiver.steps == ['start', 'slept', 'urgent', 'reply', None]
+        
+    def test_conflation(self):
+        receiver = QuoteReceiver()
+        messageManager.register_receiver(receiver)
+        for price in range(100):
+            messageManager.queue_message(Quote(symbol='AAPL', price=price))
+            messageManager.queue_message(Quote(symbol='MSFT', price=price * 2))
+        messageManager.queue_message(Test(name='unrelated'))
+        assert messageManager.get_message_count() == 3
+        messageManager.tick()
+        assert receiver.quotes == [('AAPL', 99), ('MSFT', 198)]
+        messageManager.queue_message(Quote(symbol='AAPL', price=100))
+        messageManager.tick()
+        assert receiver.quotes[-1] == ('AAPL', 100)
+        # the replacement keeps the lane of the message it replaces
+        messageManager.queue_message(Quote(symbol='AAPL', price=101))
+        messageManager.queue_message(Quote(symbol='MSFT', price=202))
+        messageManager.queue_message(Quote(symbol='AAPL', price=102), priority=10)
+        assert messageManager.get_message_count(10) == 0
+        messageManager.tick()
+        assert receiver.quotes[-2:] == [('AAPL', 102), ('MSFT', 202)]
+        
+    def test_queueCapacityReject(self):
+        receiver = ManyMsgReceiver()
+        messageManager.register_receiver(receiver)
+        messageManager.set_queue_capacity(2, 'Test')
+        assert messageManager.queue_message(Test(name='1'))
+        assert messageManager.queue_message(Test(name='2'))
+        assert not messageManager.queue_message(Test(name='3'))
+        assert messageManager.queue_message(Urgent(name='other type'))
+        assert messageManager.get_queue_stats()['dropped'] == {'Test': 1}
+        messageManager.tick()
+        assert receiver.counter == 2
+        assert messageManager.queue_message(Test(name='4'))
+        
+    def test_queueCapacityDropOldest(self):
+        receiver = OrderReceiver()
+        messageManager.register_receiver(receiver)
+        messageManager.set_queue_capacity(2, policy=OVERFLOW_DROP_OLDEST)
+        for i in range(4):
+            assert messageManager.queue_message(Test(name=i))
+        assert messageManager.get_message_count() == 2
+        messageManager.tick()
+        assert receiver.received == [2, 3]
+        assert messageManager.get_queue_stats()['overflows'] == {'Test': 2}
+    def test_queueCapacityBothLimits(self):
+        receiver = OrderReceiver()
+        messageManager.register_receiver(receiver)
+        messageManager.set_queue_capacity(1, 'Test', policy=OVERFLOW_DROP_OLDEST)
+        messageManager.set_queue_capacity(3)
+        messageManager.queue_message(Test(name=1))
+        messageManager.queue_message(Urgent(name=2))
+        messageManager.queue_message(Urgent(name=3))
+        messageManager.set_queue_capacity(2)
+        # the whole queue rejects the message, so the oldest message of its type is not dropped for it
+        assert not messageManager.queue_message(Test(name=4))
+        assert messageManager.get_message_count() == 3
+        assert messageManager.get_queue_stats()['dropped'] == {'Test': 1}
+        messageManager.tick()
+        assert receiver.received == [2, 3, 1]
+    def test_queueCapacityDropOldestWhileDispatching(self):
+        receiver = Requeuer()
+        messageManager.register_receiver(receiver)
+        messageManager.set_queue_capacity(1, 'Test', policy=OVERFLOW_DROP_OLDEST)
+        messageManager.queue_message(Test(name='old'))
+        messageManager.queue_message(Urgent(name='u'))
+        messageManager.tick()
+        # the message still waiting in the tick in progress is dropped for the new one
+        assert receiver.accepted == True
+        assert receiver.received == []
+        messageManager.tick()
+        assert receiver.received == ['new']
+        assert messageManager._type_counts['Test'] == 0
+    def test_queueCapacitySetWhileDispatching(self):
+        messageManager.register_receiver(CapacitySetter())
+        for i in range(3):
+            messageManager.queue_message(Test(name=i))
+        messageManager.tick()
+        assert messageManager._type_counts['Test'] == 0
+        for i in range(6):
+            messageManager.queue_message(Test(name=i))
+        assert messageManager.get_message_count() == 5
+        
+    def test_queueCapacitySignal(self):
+        signalled = []
+        def on_overflow(msg):
+            signalled.append(msg)
+            return 'full'
+        messageManager.set_queue_capacity(1, policy=OVERFLOW_SIGNAL, callback=on_overflow)
+        assert messageManager.queue_message(Test(name='1'))
+        assert messageManager.is_over_high_water_mark()
+        assert messageManager.queue_message(Test(name='2')) == 'full'
+        assert len(signalled) == 1
+        messageManager.tick()
+        assert not messageManager.is_over_high_water_mark()
+        
+    def test_metrics(self):
+        assert messageManager.get_metrics() is None
+        messageManager.enable_metrics()
+        receiver = SlowReceiver()
+        messageManager.register_receiver(receiver)
+        messageManager.queue_message(Test(name='1'))
+        messageManager.queue_message(Test(name='2'))
+        messageManager.queue_message(Urgent(name='3'))
+        messageManager.tick()
+        metrics = messageManager.get_metrics()
+        assert metrics['ticks'] == 1
+        assert metrics['queue_high_water_mark'] == 3
+        assert metrics['message_types']['Test']['count'] == 2
+        assert metrics['message_types']['Test']['handler_time'] >= .2
+        # the second message waited for the first handler
+        assert metrics['message_types']['Test']['latency_p99'] >= .1
+        assert metrics['message_types']['Urgent']['count'] == 1
+        assert metrics['phases']['dispatch'] >= .2
+        assert 'coroutines' in metrics['phases']
+        messageManager.disable_metrics()
+        
+    def test_delayedMessage(self):
+        receiver = OrderReceiver()
+        messageManager.register_receiver(receiver)
+        assert messageManager.queue_message(Test(name='later'), delay=.2)
+        assert messageManager.queue_message(Test(name='at'), deliver_at=util.get_time() + .1)
+        messageManager.queue_message(Test(name='now'))
+        assert messageManager.get_message_count() == 1
+        assert messageManager.next_tick_delay() == 0
+        messageManager.tick()
+        assert receiver.received == ['now']
+        assert 0 < messageManager.next_tick_delay() <= .2
+        time.sleep(.15)
+        messageManager.tick()
+        assert receiver.received == ['now', 'at']
+        time.sleep(.1)
+        messageManager.tick()
+        assert receiver.received == ['now', 'at', 'later']
+        assert messageManager.next_tick_delay() is None
+        
+    def test_handlerCachedOnRegister(self):
+        receiver = ManyMsgReceiver()
+        messageManager.register_receiver(receiver)
+        assert messageManager.message_handler_map['Test'][receiver] == receiver.handle_Test
+        messageManager.queue_message(Test(name='bla'))
+        messageManager.tick()
+        assert receiver.counter == 1
+        
+    def test_dispatchTableInvalidated(self):
+        receiver1 = ManyMsgReceiver()
+        receiver2 = ManyMsgReceiver()
+        messageManager.register_receiver(receiver1)
+        messageManager.trigger(Test(name='bla'))
+        messageManager.register_receiver(receiver2)
+        messageManager.trigger(Test(name='bla'))
+        messageManager.unregister_receiver(receiver1)
+        messageManager.trigger(Test(name='bla'))
+        assert receiver1.counter == 2
+        assert receiver2.counter == 2
+        
+    def test_topicPatterns(self):
+        receiver = TopicReceiver()
+        messageManager.register_receiver(receiver)
+        assert len(messageManager.topic_trie) == 2
+        # a receiver's handler for the concrete type wins over its pattern handlers
+        assert messageManager.trigger(Message(message_type='market.fx.EUR')) == False
+        assert receiver.received == [('EUR', 'market.fx.EUR')]
+        del receiver.received[:]
+        messageManager.trigger(Message(message_type='market.bonds'))
+        messageManager.trigger(Message(message_type='market'))
+        messageManager.trigger(Message(message_type='news.eq.AAPL'))
+        messageManager.trigger(Message(message_type='market.eq.AAPL.open'))
+        assert receiver.received == [('market', 'market.bonds'), ('market', 'market'), ('market', 'market.eq.AAPL.open')]
+        messageManager.remove_receiver(receiver, 'market.#')
+        assert len(messageManager.topic_trie) == 1
+        assert messageManager.trigger(Message(message_type='market.eq.AAPL')) == True
+        assert messageManager.trigger(Message(message_type='market.bonds')) == False
+        assert receiver.received[-1] == ('AAPL', 'market.eq.AAPL')
+        messageManager.remove_receiver(receiver, 'market.*.AAPL')
+        assert not messageManager.topic_trie.root.children
+        
+    def test_dispatchCacheSize(self):
+        receiver = TopicReceiver()
+        messageManager.register_receiver(receiver)
+        size = messageManager.dispatch_cache_size
+        messageManager.dispatch_cache_size = 4
+        try:
+            # every ad hoc topic gets its own tables, the caches are emptied when they are full
+            for i in range(10):
+                messageManager.trigger(Message(message_type='market.eq.S%d' % i))
+            assert len(messageManager._dispatch_table) <= 4
+            assert len(messageManager._pattern_table) <= 4
+            assert len(messageManager._wildcard_dispatch_table) <= 4
+            assert receiver.received == [('market', 'market.eq.S%d' % i) for i in range(10)]
+            # evicted tables are built again
+            messageManager.trigger(Message(message_type='market.eq.S0'))
+            assert receiver.received[-1] == ('market', 'market.eq.S0')
+        finally:
+            messageManager.dispatch_cache_size = size
+        
+    def test_topicTrieMatch(self):
+        trie = TopicTrie()
+        trie.add('a.*.c', 1)
+        trie.add('a.#', 2)
+        trie.add('*.b.*', 3)
+        trie.add('a.b.c', 4)
+        assert sorted(r for r, p in trie.match('a.b.c')) == [1, 2, 3, 4]
+        assert sorted(r for r, p in trie.match('a')) == [2]
+        assert sorted(r for r, p in trie.match('x.b.y')) == [3]
+        self.assertRaises(ValueError, trie.add, 'a.#.c', 5)
+        assert handler_name('market.*.AAPL') == 'handle_market_any_AAPL'
+        assert handler_name('Test') == 'handle_Test'
+        
+    def test_postFromThreads(self):
+        receiver = ManyMsgReceiver()
+        messageManager.register_receiver(receiver)
+        event = messageManager.get_ingress_event()
+        def produce():
+            for i in range(100):
+                messageManager.post_message(Test(name='bla'))
+            messageManager.post_messages([Test(name='bla') for i in range(100)])
+        producers = [threading.Thread(target=produce) for i in range(4)]
+        for t in producers:
+            t.start()
+        for t in producers:
+            t.join()
+        assert event.is_set()
+        assert messageManager.get_message_count() == 0
+        assert messageManager.next_tick_delay() == 0
+        messageManager.tick()
+        assert not event.is_set()
+        assert receiver.counter == 800
+        
+    @unittest.skipIf(FUTURES_AVAILABLE, 'concurrent.futures is available, handlers run in the pools')
+    def test_offloadedHandlerInline(self):
+        receiver = BlockingReceiver()
+        messageManager.register_receiver(receiver)
+        messageManager.set_offload_pools(threads=4)
+        for name in 'abc':
+            messageManager.queue_message(Test(name=name))
+        messageManager.tick()
+        assert receiver.threads == [threading.current_thread()] * 3
+        messageManager.tick()
+        assert receiver.replies == ['a', 'b', 'c']
+    @unittest.skipIf(not FUTURES_AVAILABLE, 'concurrent.futures is not available')
+    def test_offloadedHandler(self):
+        receiver = BlockingReceiver()
+        messageManager.register_receiver(receiver)
+        messageManager.set_offload_pools(threads=4)
+        for name in 'abc':
+            messageManager.queue_message(Test(name=name))
+        messageManager.tick()
+        assert receiver.threads == []
+        start = time.time()
+        while len(receiver.replies) < 3 and time.time() - start < 2:
+            messageManager.get_ingress_event().wait(.1)
+            messageManager.tick()
+        assert threading.current_thread() not in receiver.threads
+        messageManager.tick()
+        # results come back in dispatch order
+        assert receiver.replies == ['a', 'b', 'c']
+    @unittest.skipIf(not FUTURES_AVAILABLE, 'concurrent.futures is not available')
+    def test_offloadedProcessHandler(self):
+        receiver = CrunchReceiver()
+        messageManager.register_receiver(receiver)
+        messageManager.set_offload_pools(processes=1)
+        # an adhoc message type survives the trip to the pool process
+        messageManager.queue_message(Message(message_type='Crunch'))
+        start = time.time()
+        while not receiver.results and time.time() - start < 5:
+            messageManager.get_ingress_event().wait(.1)
+            messageManager.tick()
+        messageManager.tick()
+        assert len(receiver.results) == 1
+        name, pid = receiver.results[0]
+        assert name == 'Crunch'
+        assert pid != os.getpid()
+    def test_offloadProcessNeedsStaticmethod(self):
+        def handle_Test(self, msg):
+            pass
+        self.assertRaises(TypeError, offload(OFFLOAD_PROCESS), handle_Test)
+    def test_offloadUnknownPool(self):
+        self.assertRaises(ValueError, offload, 'threads')
+    def test_offloadBatchHandlerRejected(self):
+        class OffloadedBatch(BatchReceiver):
+            @offload
+            def handle_batch_Test(self, msgs):
+                pass
+        receiver = OffloadedBatch()
+        def deliver():
+            messageManager.register_receiver(receiver)
+            messageManager.queue_message(Test(name='a'))
+            messageManager.tick()
+        self.assertRaises(TypeError, deliver)
+        
+    def test_batchHandler(self):
+        receiver = BatchReceiver()
+        ordinary = ManyMsgReceiver()
+        messageManager.register_receiver(receiver)
+        messageManager.register_receiver(ordinary)
+        for name in 'abc':
+            messageManager.queue_message(Test(name=name))
+        messageManager.queue_message(Urgent(name='u'))
+        messageManager.tick()
+        # batches are handled after every message of the tick was dispatched
+        assert receiver.calls == ['Urgent', ('Test', ['a', 'b', 'c'])]
+        assert ordinary.counter == 3
+        messageManager.trigger(Test(name='d'))
+        assert receiver.calls[-1] == ('Test', ['d'])
+        batch = MessageBatch('Test')
+        batch.extend([Test(name=1), Test(name=2)])
+        assert list(batch.column('name', 'd')) == [1.0, 2.0]
+    def test_batchHandlerTriggeredDuringTick(self):
+        receiver = PosBatcher()
+        messageManager.register_receiver(receiver)
+        messageManager.queue_message(Pos(name=1))
+        messageManager.queue_message(Hit(name='hit'))
+        messageManager.queue_message(Pos(name=2))
+        messageManager.tick()
+        # the triggered message joins the tick's batch, which runs once after the whole tick
+        assert receiver.calls == ['Hit', [1, 'hit', 2]]
+        messageManager.trigger(Hit(name='alone'))
+        assert receiver.calls[-2:] == ['Hit', ['alone']]
+    def test_batchHandlerProfiled(self):
+        messageManager.register_receiver(SlowBatchReceiver())
+        messageManager.enable_metrics()
+        messageManager.enable_profiling(.02)
+        try:
+            for name in 'ab':
+                messageManager.queue_message(Test(name=name))
+            messageManager.tick()
+            report = messageManager.get_slow_report()
+            metrics = messageManager.get_metrics()
+        finally:
+            messageManager.disable_profiling()
+            messageManager.disable_metrics()
+        # the flush is timed once, collecting the messages is not slow
+        assert [(x['class'], x['message_type'], x['count']) for x in report] == [('SlowBatchReceiver', 'Test', 1)]
+        assert metrics['message_types']['Test']['count'] == 2
+        assert metrics['message_types']['Test']['handler_time'] >= .02
+    def test_profilerSamplesCallingThread(self):
+        profiler = Profiler(.02, sample_stacks=True)
+        receiver = Receiver()
+        def inner():
+            pass
+        def outer():
+            # the outer call is still sampled once the nested call returned
+            profiler.call(receiver, 'inner', inner)
+            time.sleep(.06)
+        try:
+            worker = threading.Thread(target=profiler.call, args=(receiver, 'outer', outer))
+            worker.start()
+            worker.join()
+        finally:
+            profiler.stop()
+        assert [x[1] for x in profiler.slow_calls] == ['outer']
+        assert 'in outer' in profiler.slow_calls[0][3]
+        
+    def test_expiredMessagesDropped(self):
+        receiver = ManyMsgReceiver()
+        messageManager.register_receiver(receiver)
+        expired = []
+        messageManager.set_expiry_callback(expired.append)
+        stale = Test(name='stale')
+        messageManager.queue_message(stale, ttl=.05)
+        messageManager.queue_message(Test(name='fresh'), ttl=5)
+        messageManager.queue_message(Test(name='forever'))
+        time.sleep(.06)
+        messageManager.tick()
+        assert receiver.counter == 2
+        assert expired == [stale]
+        assert messageManager.get_queue_stats()['expired'] == {'Test': 1}
+        
     def tearDown(self):
         messageManager.reset()
         
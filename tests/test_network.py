@@ -136,6 +136,15 @@ class PongReceiver(Actor):
         self.ack_success = True
         self.sender = msg.sender
 
+class AmountReceiver(Actor):
+    subscriptions = ['TestMessage1']
+    def __init__(self):
+        Actor.__init__(self)
+        self.amounts = []
+    def handle_TestMessage1(self, msg):
+        self.amounts.append(msg.get_property('amount'))
+        return True
+
 class TestNetwork(unittest.TestCase):
     def test_packet_creation(self):
         p = TestMessage1(amount=1)
@@ -336,6 +345,91 @@ class TestNetwork(unittest.TestCase):
         # confirms that the client received the syn-ack message by verifying that the server received "ack"
         assert nmanager.find('pong_receiver').syn_success == True
         assert nmanager.find('pong_receiver').ack_success == True
+    def test_backpressure(self):
+        receiver = nmanager.register_actor(AmountReceiver())
+        nmanager.listen(host='127.0.0.1', port=0)
+        client = transport.SelectUDPTransport()
+        client.connect(*nmanager.transport.address)
+        for i in range(5):
+            client.send(TestMessage1(amount=i).to_string())
+        time.sleep(.2)
+        nmanager.set_queue_capacity(2)
+        # the manager stops reading from the transport once two messages are queued
+        nmanager.tick()
+        assert receiver.amounts == [0, 1]
+        nmanager.tick()
+        nmanager.tick()
+        assert receiver.amounts == [0, 1, 2, 3, 4]
+        client.disconnect()
+        nmanager.transport.disconnect()
+    def test_wait_for_network(self):
+        receiver = nmanager.register_actor(AmountReceiver())
+        nmanager.listen(host='127.0.0.1', port=0)
+        client = transport.SelectUDPTransport()
+        client.connect(*nmanager.transport.address)
+        assert nmanager.wait(.1) == False
+        client.send(TestMessage1(amount=7).to_string())
+        start = time.time()
+        assert nmanager.wait(5.0) == True
+        assert time.time() - start < 1.0
+        nmanager.tick()
+        assert receiver.amounts == [7]
+        client.disconnect()
+        nmanager.transport.disconnect()
+    def test_fair_queuing(self):
+        receiver = nmanager.register_actor(AmountReceiver())
+        nmanager.listen(host='127.0.0.1', port=0, transport_class=transport.SelectTCPTransport)
+        nmanager.enable_fair_queuing(quantum=1, backlog_limit=10, budget=4)
+        flooder = transport.SelectTCPTransport()
+        flooder.connect(*nmanager.transport.address)
+        client = transport.SelectTCPTransport()
+        client.connect(*nmanager.transport.address)
+        for i in range(50):
+            flooder.send(TestMessage1(amount=1000 + i).to_string())
+        for i in range(3):
+            client.send(TestMessage1(amount=i).to_string())
+        time.sleep(.2)
+        nmanager.tick()
+        # the senders take turns, the flooder is not read from until its backlog drains
+        assert len(receiver.amounts) == 4
+        assert len([a for a in receiver.amounts if a < 1000]) == 2
+        stats = nmanager.get_peer_stats()
+        assert stats[flooder.address]['paused'] == True
+        assert stats[flooder.address]['released'] == 2
+        assert stats[client.address]['backlog'] == 1
+        nmanager.tick()
+        assert [a for a in receiver.amounts if a < 1000] == [0, 1, 2]
+        for i in range(15):
+            nmanager.tick()
+        assert [a for a in receiver.amounts if a >= 1000] == range(1000, 1050)
+        stats = nmanager.get_peer_stats()
+        assert stats[flooder.address] == {'backlog': 0, 'received': 50, 'released': 50, 'weight': 1, 'paused': False}
+        flooder.disconnect()
+        client.disconnect()
+        nmanager.transport.disconnect()
+    def test_fair_queuing_disconnect(self):
+        receiver = nmanager.register_actor(AmountReceiver())
+        nmanager.listen(host='127.0.0.1', port=0, transport_class=transport.SelectTCPTransport)
+        nmanager.enable_fair_queuing(quantum=1, backlog_limit=5, budget=2)
+        flooder = transport.SelectTCPTransport()
+        flooder.connect(*nmanager.transport.address)
+        address = flooder.address
+        nmanager.set_peer_weight(address, 2)
+        for i in range(20):
+            flooder.send(TestMessage1(amount=i).to_string())
+        time.sleep(.2)
+        nmanager.tick()
+        assert nmanager.get_peer_stats()[address]['paused'] == True
+        flooder.disconnect()
+        for i in range(15):
+            nmanager.tick()
+            time.sleep(.01)
+        # what the peer sent before it disconnected is delivered, then it is forgotten
+        assert receiver.amounts == range(20)
+        assert nmanager.get_peer_stats() == {}
+        fair = nmanager.fair_input
+        assert not (fair.backlogs or fair.deficits or fair.weights or fair.received or fair.released or fair.paused)
+        nmanager.transport.disconnect()
     def tearDown(self):
         nmanager.clear_process_group()
         nmanager.reset()
@@ -1,8 +1,12 @@
 # test_system.py
 # unit test that excercises the object manager system
-from pysage import Actor, ActorManager, Message
-from pysage.system import ConcreteMessageAlreadyDefined, PacketTypeError
+from pysage import Actor, ActorManager, Message, CompactMessage, ActorArray, ArrayEntry
+from pysage.system import ConcreteMessageAlreadyDefined, PacketTypeError, PacketError, ASYNCIO_AVAILABLE, asyncio, InterestNotSet
+from pysage import Sleep
+from pysage.messaging import InvalidMessageProperty
 import time
+import gc
+import pickle
 import unittest
 
 mgr = ActorManager.get_singleton()
@@ -11,6 +15,50 @@ class TakeDamage(Message):
     properties = ['damageAmount']
     packet_type = 104
 
+class Spectator(Actor):
+    subscriptions = ['*']
+    def __init__(self):
+        Actor.__init__(self)
+        self.seen = []
+    def handle_TakeDamage(self, msg):
+        self.seen.append(msg)
+        return True
+
+class TopicWatcher(Actor):
+    subscriptions = ['damage.*']
+    def __init__(self):
+        Actor.__init__(self)
+        self.seen = []
+    def handle_message(self, msg):
+        self.seen.append(msg.message_type)
+        return False
+
+class BatchPunk(Actor):
+    subscriptions = ['TakeDamage']
+    def __init__(self):
+        Actor.__init__(self)
+        self.batches = []
+    def handle_batch_TakeDamage(self, msgs):
+        self.batches.append(msgs.column('damageAmount'))
+
+class CompactDamage(CompactMessage):
+    properties = ['damageAmount', 'source']
+    types = ['i', 'p']
+    packet_type = 130
+
+class Explosion(Message):
+    properties = ['position', 'damageAmount']
+    location = 'position'
+
+class Bystander(Actor):
+    subscriptions = ['Explosion']
+    def __init__(self):
+        Actor.__init__(self)
+        self.hits = 0
+    def handle_Explosion(self, msg):
+        self.hits += 1
+        return False
+
 class Punk(Actor):
     pass
 
@@ -23,6 +71,44 @@ class RealPunk(Actor):
         self.damage += msg.get_property('damageAmount')
         return True
     
+class SleepyPunk(RealPunk):
+    '''a pysage coroutine handler'''
+    def handle_TakeDamage(self, msg):
+        yield Sleep(.01)
+        self.damage += msg.get_property('damageAmount')
+
+class SlowPunk(RealPunk):
+    def handle_TakeDamage(self, msg):
+        time.sleep(.1)
+        return RealPunk.handle_TakeDamage(self, msg)
+    def update(self):
+        time.sleep(.05)
+
+class Ticker(RealPunk):
+    def __init__(self, log, priority=0):
+        RealPunk.__init__(self)
+        self.log = log
+        self._SYNC_PRIORITY = priority
+    def update(self):
+        self.log.append(self)
+
+class SlowTicker(Ticker):
+    update_every = 3
+
+class Drone(ArrayEntry):
+    subscriptions = ['TakeDamage']
+    def handle_TakeDamage(self, msg):
+        self['hp'] -= msg.get_property('damageAmount')
+        return True
+
+class Swarm(ActorArray):
+    columns = ['x', 'vx', ('hp', 'i')]
+    entry_class = Drone
+    def update_batch(self):
+        x, vx = self.column('x'), self.column('vx')
+        for i in xrange(len(self)):
+            x[i] += vx[i]
+
 class DumbPunk(Actor):
     subscriptions = ['BombMessage']
     def __init__(self):
@@ -101,6 +187,20 @@ class TestGameObject(unittest.TestCase):
         assert obj1.damage == 3
         assert obj2.damage == 0
                                 
+    def test_queueToObjectDirectRoute(self):
+        punks = [RealPunk() for i in range(100)]
+        for p in punks:
+            mgr.register_actor(p)
+        spectator = mgr.register_actor(Spectator())
+        target = punks[42]
+        mgr.queue_message_to_actor(target.gid, TakeDamage(damageAmount=3))
+        # designated to an actor that is no longer registered
+        mgr.unregister_actor(punks[0])
+        mgr.queue_message_to_actor(punks[0].gid, TakeDamage(damageAmount=5))
+        mgr.tick(None)
+        assert [p.damage for p in punks] == [0] * 42 + [3] + [0] * 57
+        assert len(spectator.seen) == 2
+                                
     def test_queue_message(self):
         obj = RealPunk()
         mgr.register_actor(obj)
@@ -110,11 +210,296 @@ class TestGameObject(unittest.TestCase):
         assert mgr.tick(None)
         assert obj.damage == 2
         
+    def test_compact_message(self):
+        msg = CompactDamage(damageAmount=3)
+        # the instance dictionary of a compact message is never allocated
+        assert not [r for r in gc.get_referents(msg) if type(r) == dict]
+        assert msg.message_type == 'CompactDamage'
+        assert msg.get_property('damageAmount') == 3
+        assert msg.get_property('source', 'bomb') == 'bomb'
+        msg.set_property('source', 'punk')
+        assert msg.get_property('source') == 'punk'
+        assert msg.gid != CompactDamage().gid
+        self.assertRaises(InvalidMessageProperty, msg.get_property, 'bad')
+        self.assertRaises(TypeError, CompactDamage, bad='bad')
+        # there is no instance dictionary to hold other attributes
+        self.assertRaises(AttributeError, setattr, msg, 'foo', 1)
+        assert not hasattr(msg, '__dict__')
+    def test_compact_message_pack(self):
+        msg = CompactDamage(damageAmount=3, source='punk')
+        unpacked = CompactDamage().from_string(msg.to_string())
+        assert unpacked.get_property('damageAmount') == 3
+        assert unpacked.get_property('source') == 'punk'
+        assert unpacked.deadline is None
+    def test_deadline_travels(self):
+        msg = CompactDamage(damageAmount=3, source='punk')
+        msg.set_ttl(5)
+        unpacked = CompactDamage().from_string(msg.to_string())
+        assert unpacked.get_property('source') == 'punk'
+        assert 4 < unpacked.deadline - time.time() <= 5
+        msg.set_ttl(0)
+        unpacked = CompactDamage().from_string(msg.to_string())
+        assert unpacked.deadline <= time.time()
+        # trailing bytes are not taken for a deadline without the trailer marker
+        msg = CompactDamage(damageAmount=3, source='punk')
+        # pickled (for process groups), the type of an ad-hoc message and the deadline are kept
+        msg = CompactDamage(message_type='Blast', damageAmount=3)
+        msg.set_ttl(5)
+        unpickled = pickle.loads(pickle.dumps(msg, 2))
+        assert (unpickled.message_type, unpickled.deadline) == ('Blast', msg.deadline)
+        assert unpickled.get_property('damageAmount') == 3
+        msg = CompactDamage(damageAmount=3, source='punk')
+        for size in (4, 9):
+            self.assertRaises(PacketError, CompactDamage().from_string, msg.to_string() + '\x00' * size)
+    @unittest.skipIf(not ASYNCIO_AVAILABLE, 'asyncio (trollius) is not available')
+    def test_event_loop_mode(self):
+        loop = asyncio.new_event_loop()
+        obj = RealPunk()
+        mgr.register_actor(obj)
+        mgr.attach_event_loop(loop)
+        try:
+            mgr.queue_message(TakeDamage(damageAmount=4))
+            loop.call_later(.05, loop.stop)
+            loop.run_forever()
+        finally:
+            mgr.detach_event_loop()
+            loop.close()
+        assert obj.damage == 4
+    @unittest.skipIf(not ASYNCIO_AVAILABLE, 'asyncio (trollius) is not available')
+    def test_event_loop_coroutine_handler(self):
+        loop = asyncio.new_event_loop()
+        class LoopPunk(RealPunk):
+            @asyncio.coroutine
+            def handle_TakeDamage(self, msg):
+                # the value of the awaited future, a pysage coroutine would be resumed with None
+                amount = yield asyncio.From(asyncio.sleep(.01, msg.get_property('damageAmount'), loop=loop))
+                self.damage += amount
+        looped = mgr.register_actor(LoopPunk())
+        sleepy = mgr.register_actor(SleepyPunk())
+        mgr.attach_event_loop(loop)
+        try:
+            mgr.queue_message(TakeDamage(damageAmount=4))
+            loop.call_later(.2, loop.stop)
+            loop.run_forever()
+        finally:
+            mgr.detach_event_loop()
+            loop.close()
+        # the task awaited its sleep on the loop, the pysage coroutine was resumed by a tick
+        assert looped.damage == 4
+        assert sleepy.damage == 4
+    @unittest.skipIf(not ASYNCIO_AVAILABLE, 'asyncio (trollius) is not available')
+    def test_event_loop_coroutine_handler_profiled(self):
+        loop = asyncio.new_event_loop()
+        class LoopPunk(RealPunk):
+            @asyncio.coroutine
+            def handle_TakeDamage(self, msg):
+                amount = yield asyncio.From(asyncio.sleep(.01, msg.get_property('damageAmount'), loop=loop))
+                self.damage += amount
+        looped = mgr.register_actor(LoopPunk())
+        mgr.enable_profiling(1)
+        mgr.attach_event_loop(loop)
+        try:
+            # the profiled handlers are looked through, both on the broadcast and the designated path
+            mgr.queue_message(TakeDamage(damageAmount=4))
+            mgr.queue_message_to_actor(looped.gid, TakeDamage(damageAmount=3))
+            loop.call_later(.2, loop.stop)
+            loop.run_forever()
+        finally:
+            mgr.detach_event_loop()
+            mgr.disable_profiling()
+            loop.close()
+        assert looped.damage == 7
+        assert not mgr.coroutines
+    def test_tick_metrics(self):
+        mgr.enable_metrics()
+        obj = RealPunk()
+        mgr.register_actor(obj)
+        mgr.queue_message(TakeDamage(damageAmount=1))
+        mgr.tick()
+        metrics = mgr.get_metrics()
+        assert metrics['message_types']['TakeDamage']['count'] == 1
+        assert set(metrics['phases']) == set(['ipc_poll', 'network_poll', 'coroutines', 'dispatch', 'actor_update'])
+    def test_slow_call_profiling(self):
+        slow = mgr.register_actor(SlowPunk())
+        mgr.enable_profiling(.03, sample_stacks=True)
+        try:
+            mgr.queue_message_to_actor(slow.gid, TakeDamage(damageAmount=1))
+            mgr.queue_message(TakeDamage(damageAmount=1))
+            mgr.tick()
+            mgr.tick()
+            report = mgr.get_slow_report()
+        finally:
+            mgr.disable_profiling()
+        assert [(x['class'], x['message_type'], x['count']) for x in report] == [('SlowPunk', 'TakeDamage', 2), ('SlowPunk', 'update', 2)]
+        assert 'handle_TakeDamage' in report[0]['stack']
+        assert slow.damage == 2
+    def test_update_scheduling(self):
+        log = []
+        low = mgr.register_actor(Ticker(log))
+        high = mgr.register_actor(Ticker(log, priority=5))
+        slow = mgr.register_actor(SlowTicker(log))
+        mgr.register_actor(Punk())
+        mgr.tick()
+        assert log == [high, low]
+        del log[:]
+        mgr.tick()
+        mgr.tick()
+        assert log == [high, low, high, low, slow]
+        del log[:]
+        assert low.sleep()
+        mgr.tick()
+        assert log == [high]
+        # a message wakes the actor up, it is updated on the same tick
+        mgr.queue_message_to_actor(low.gid, TakeDamage(damageAmount=1))
+        mgr.tick()
+        assert low.damage == 1
+        assert log == [high, high, low]
+        mgr.unregister_actor(high)
+        del log[:]
+        mgr.tick()
+        assert log == [low, slow]
+    def test_sleep_patches_dispatch(self):
+        awake, dozer = mgr.register_actors([Ticker([]), Ticker([])])
+        table = mgr._get_dispatch('TakeDamage')
+        handlers = dict(table)
+        assert dozer.sleep()
+        # the cached table is not built again, only the sleeping actor's entry is replaced
+        assert mgr._get_dispatch('TakeDamage') is table
+        assert dict(table)[awake] is handlers[awake]
+        assert dict(table)[dozer] is not handlers[dozer]
+        mgr.queue_message_to_actor(dozer.gid, TakeDamage(damageAmount=1))
+        mgr.tick()
+        assert dozer.damage == 1
+        assert dozer.log == [dozer]
+        assert mgr._get_dispatch('TakeDamage') is table
+        assert dict(table)[dozer] == handlers[dozer]
+    def test_sleep_wildcard_actor(self):
+        spectator = mgr.register_actor(Spectator())
+        mgr.trigger(TakeDamage(damageAmount=1))
+        assert spectator.sleep()
+        mgr.trigger(TakeDamage(damageAmount=1))
+        assert spectator not in mgr._sleeping
+        assert spectator.sleep()
+        mgr.queue_message_to_actor(spectator.gid, TakeDamage(damageAmount=1))
+        mgr.tick()
+        assert spectator not in mgr._sleeping
+        assert len(spectator.seen) == 3
+    def test_sleep_pattern_actor(self):
+        watcher = mgr.register_actor(TopicWatcher())
+        mgr.trigger(Message(message_type='damage.fire'))
+        assert watcher.sleep()
+        mgr.queue_message(Message(message_type='damage.fire'))
+        mgr.tick()
+        assert watcher not in mgr._sleeping
+        assert watcher.seen == ['damage.fire', 'damage.fire']
+    def test_sleep_batch_actor(self):
+        punk = mgr.register_actor(BatchPunk())
+        assert punk.sleep()
+        for i in range(3):
+            mgr.queue_message(TakeDamage(damageAmount=i))
+        mgr.tick()
+        # waking up on the first message does not split the batch
+        assert punk.batches == [[0, 1, 2]]
+        # synchronous designated messages go through the dispatch table too
+        assert punk.sleep()
+        mgr.trigger_to_actor(punk.gid, TakeDamage(damageAmount=5))
+        assert punk not in mgr._sleeping
+        assert punk.batches[-1] == [5]
+    def test_interest_management(self):
+        near, far, everywhere = mgr.register_actors([Bystander(), Bystander(), Bystander()])
+        # without interest management, clearing does nothing and moving is an error
+        mgr.clear_interest(near)
+        self.assertRaises(InterestNotSet, mgr.move_actor, near, (0, 0))
+        mgr.enable_interest_management(cell_size=10)
+        self.assertRaises(InterestNotSet, mgr.move_actor, everywhere, (0, 0))
+        mgr.set_interest(near, (0, 0), 5)
+        mgr.set_interest(far, (100, 100), 5)
+        mgr.queue_message(Explosion(position=(3, 3), damageAmount=1))
+        mgr.tick()
+        assert (near.hits, far.hits, everywhere.hits) == (1, 0, 1)
+        # moving within the same cells, then across cells
+        mgr.move_actor(far, (101, 100))
+        mgr.move_actor(far, (4, 0))
+        assert (10, 10) not in mgr.interest_grid.cells
+        mgr.trigger(Explosion(position=(3, 3), damageAmount=1))
+        assert (near.hits, far.hits, everywhere.hits) == (2, 1, 2)
+        mgr.unregister_actor(near)
+        assert near not in mgr.interest_grid
+        mgr.clear_interest(far)
+        mgr.clear_interest(far)
+        mgr.trigger(Explosion(position=(500, 500), damageAmount=1))
+        assert (far.hits, everywhere.hits) == (2, 3)
+    def test_actor_array(self):
+        swarm = Swarm()
+        swarm.spawn(2, vx=1.0, hp=10)
+        mgr.register_actor_array(swarm)
+        third = swarm.spawn(vx=2.0, hp=10)[0]
+        mgr.tick()
+        assert list(swarm.column('x')) == [1.0, 1.0, 2.0]
+        mgr.queue_message_to_actor(third.gid, TakeDamage(damageAmount=3))
+        mgr.tick()
+        assert third['hp'] == 7 and third['x'] == 4.0
+        # the last member takes the row of the removed one
+        swarm.despawn([swarm.entries[0]])
+        assert mgr.get_actor(third.gid) is third and third.index == 0
+        assert list(swarm.column('hp')) == [7, 10]
+        mgr.unregister_actor_array(swarm)
+        assert len(mgr.actors) == 0
+    def test_actor_timers(self):
+        calls = []
+        obj = mgr.register_actor(RealPunk())
+        every = obj.schedule_every(.05, calls.append, 'every')
+        obj.schedule_once(.05, calls.append, 'once')
+        mgr.tick()
+        assert calls == []
+        time.sleep(.06)
+        mgr.tick()
+        assert sorted(calls) == ['every', 'once']
+        time.sleep(.06)
+        mgr.tick()
+        assert sorted(calls) == ['every', 'every', 'once']
+        assert obj.cancel_timer(every)
+        assert not obj.cancel_timer(every)
+        obj.schedule_every(.05, calls.append, 'every')
+        mgr.unregister_actor(obj)
+        time.sleep(.06)
+        mgr.tick()
+        assert len(calls) == 3
+        assert mgr.next_tick_delay() is None
+        # timers scheduled before registration start with it, an actor that is never registered has none running
+        idle, late = RealPunk(), RealPunk()
+        idle.schedule_every(.05, calls.append, 'idle')
+        late.schedule_once(.05, calls.append, 'late')
+        assert late.cancel_timer(late.schedule_every(.05, calls.append, 'cancelled'))
+        time.sleep(.06)
+        mgr.register_actor(late)
+        mgr.tick()
+        assert len(calls) == 3
+        time.sleep(.06)
+        mgr.tick()
+        assert calls[3:] == ['late']
     def test_register_actorWithName(self):
         obj = Punk()
         mgr.register_actor(obj, 'punk')
         assert mgr.get_actor_by_name('punk') == obj
         
+    def test_register_actors(self):
+        punks = mgr.register_actors([RealPunk() for i in range(1000)], names=['boss'])
+        assert mgr.get_actor_by_name('boss') is punks[0]
+        assert len(mgr.message_receiver_map['TakeDamage']) == 1000
+        mgr.trigger(TakeDamage(damageAmount=1))
+        assert sum(p.damage for p in punks) == 1000
+        mgr.unregister_actors(punks[:500])
+        assert mgr.get_actor_by_name('boss') is None
+        assert len(mgr.actors) == 500
+        assert mgr.trigger_to_actor(punks[-1].gid, TakeDamage(damageAmount=2))
+        assert punks[-1].damage == 3
+        # a name given to another actor stays with it
+        mgr.register_actor(punks[0], 'boss')
+        mgr.register_actor(Punk(), 'boss')
+        mgr.unregister_actor(punks[0])
+        assert mgr.get_actor_by_name('boss') is not None
+        
     def tearDown(self):
         mgr.reset()
         